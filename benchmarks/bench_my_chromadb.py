@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   bench_my_chromadb.py
+@Version :   1.0
+@Desc    :   MyMilvus入库、检索、上下文拼接、查询与删除的基准测试
+
+使用临时目录中的PersistentClient、确定性的本地假向量模型(随机投影,不下载模型)
+以及不发请求的回调函数,生成指定规模的合成片段,统计吞吐量与p50/p95/p99延迟,
+结果保存为JSON,可用--baseline与之前的结果对比。
+
+用法:
+    # 在项目包内使用(推荐),--module为my_chromadb模块的完整路径
+    python benchmarks/bench_my_chromadb.py --module yourpkg.my_chromadb --chunks 10000
+    # 单独使用本仓库时,会为my_chromadb依赖的utils/configs生成最小替身
+    python benchmarks/bench_my_chromadb.py --chunks 10000 --milvus-kwargs '{"num_shards": 4}'
+'''
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+import zlib
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeEmbedder:
+    """_确定性的假向量模型_
+    文本按字符及相邻双字哈希到特征桶,再用固定随机矩阵投影,
+    共享字符越多的文本向量越相近
+    """
+
+    def __init__(self, dim=256, buckets=1 << 14, seed=0):
+        rng = np.random.default_rng(seed)
+        self.model_name_or_path = f"fake-embedder-{dim}-{seed}"
+        self.projection = rng.standard_normal(
+            (buckets, dim)).astype(np.float32)
+        self.buckets = buckets
+        self.encode_calls = 0
+        self.encoded_texts = 0
+
+    def _features(self, text):
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        return [
+            zlib.crc32(gram.encode("utf-8")) % self.buckets for gram in grams
+        ] or [0]
+
+    def encode(self, sentences, normalize_embeddings=True, **kwargs):
+        self.encode_calls += 1
+        self.encoded_texts += len(sentences)
+        vectors = np.vstack([
+            self.projection[self._features(text)].sum(axis=0)
+            for text in sentences
+        ])
+        if normalize_embeddings:
+            vectors /= np.maximum(
+                np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+
+class SyntheticChunk:
+    """_与DocumentFormat字段一致的合成片段_"""
+
+    def __init__(self, sentence, file, chunk_num, level, outline):
+        self.sentence = sentence
+        self.complete_content = sentence
+        self.is_title = int(level > 0)
+        self.is_head = int(chunk_num == 0)
+        self.level = level
+        self.outline = outline
+        self.metadata = {"source": file, "chunk_num": chunk_num}
+
+
+# 合成文本使用的字符表(常用汉字 + 产品型号样式的词)
+_CHARS = ("的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动"
+          "同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自"
+          "二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日")
+
+
+def generate_corpus(total_chunks, min_per_file, max_per_file, seed):
+    """_生成合成语料_
+    Returns:
+        _dict_: _{文件名: [SyntheticChunk]}_
+    """
+    rng = random.Random(seed)
+    corpus = {}
+    produced = 0
+    file_index = 0
+    while produced < total_chunks:
+        count = min(rng.randint(min_per_file, max_per_file),
+                    total_chunks - produced)
+        file = f"doc_{file_index:06d}.pdf"
+        chunks = []
+        outline = ""
+        for chunk_num in range(count):
+            # 约每10个片段一个标题
+            level = rng.randint(1, 3) if rng.random() < 0.1 else 0
+            code = f"PX-{rng.randint(1000, 9999)}"
+            text = "".join(
+                rng.choice(_CHARS) for _ in range(rng.randint(40, 200)))
+            if level:
+                outline = text[:12]
+                text = outline
+            chunks.append(
+                SyntheticChunk(f"{text} {code}", file, chunk_num, level,
+                               outline))
+        corpus[file] = chunks
+        produced += count
+        file_index += 1
+    return corpus
+
+
+def _install_standalone_package():
+    """_单独使用本仓库时,为my_chromadb的相对导入生成最小的包结构_
+    只替身utils(回调、DocumentFormat)与configs(配置常量),
+    my_chromadb等仓库内模块使用真实代码
+    """
+    package_name = "seal_chromdb_bench"
+    package = types.ModuleType(package_name)
+    package.__path__ = [REPO_ROOT]
+    utils = types.ModuleType(f"{package_name}.utils")
+    utils.__path__ = []
+    tools = types.ModuleType(f"{package_name}.utils.tools")
+    tools.get_callback_request = lambda url, send_msg=None: None
+    message_format = types.ModuleType(f"{package_name}.utils.message_format")
+    message_format.DocumentFormat = SyntheticChunk
+    utils.tools = tools
+    utils.message_format = message_format
+    configs = types.ModuleType(f"{package_name}.configs")
+    configs.__path__ = []
+    model_config = types.ModuleType(f"{package_name}.configs.model_config")
+    model_config.MILVUS_INSERT_BATCH = 64
+    model_config.CONTEXT_NUM = 2
+    configs.model_config = model_config
+    for module in (package, utils, tools, message_format, configs,
+                   model_config):
+        sys.modules[module.__name__] = module
+    return f"{package_name}.my_chromadb"
+
+
+def load_module(module_path):
+    if not module_path:
+        module_path = _install_standalone_package()
+    return importlib.import_module(module_path)
+
+
+class CallbackStub:
+    """_替换tools.get_callback_request,只计数不发请求_"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, url, send_msg=None):
+        self.calls += 1
+
+
+def summarize(latencies, items=None, failures=0):
+    """_统计延迟分布与吞吐量_
+    Args:
+        latencies (_list_): _每次成功操作的耗时(秒)_
+        items (_int_, optional): _成功处理的条目数,默认等于成功操作次数_
+        failures (int, optional): _失败的操作次数,不计入延迟分布_. Defaults to 0.
+    Returns:
+        _dict_: _统计结果_
+    """
+    values = np.asarray(latencies, dtype=np.float64)
+    total = float(values.sum())
+    items = len(values) if items is None else items
+    if not len(values):
+        return {"count": 0, "failures": failures}
+    return {
+        "count": len(values),
+        "failures": failures,
+        "items": items,
+        "total_s": total,
+        "throughput_per_s": items / total if total else None,
+        "p50_ms": float(np.percentile(values, 50) * 1000),
+        "p95_ms": float(np.percentile(values, 95) * 1000),
+        "p99_ms": float(np.percentile(values, 99) * 1000),
+        "max_ms": float(values.max() * 1000)
+    }
+
+
+def timed(func, *args, quiet=True, expect_result=True, **kwargs):
+    """_执行一次操作并计时,quiet时屏蔽MyMilvus的print输出_
+    MyMilvus捕获异常后只打印traceback并返回None,所以输出中出现traceback,
+    或expect_result时返回None,都视为失败
+    Returns:
+        _tuple_: _(耗时(秒), 返回值, 是否成功)_
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+    if not quiet:
+        sys.stdout.write(output.getvalue())
+    ok = "Traceback (most recent call last)" not in output.getvalue() and (
+        result is not None or not expect_result)
+    return elapsed, result, ok
+
+
+class Measurement:
+    """_收集一组操作的耗时,失败的操作只计数,不计入延迟分布与吞吐量_"""
+
+    def __init__(self):
+        self.latencies = []
+        self.items = 0
+        self.failures = 0
+
+    def add(self, timing, items=1):
+        elapsed, _, ok = timing
+        if ok:
+            self.latencies.append(elapsed)
+            self.items += items
+        else:
+            self.failures += 1
+
+    def summary(self):
+        return summarize(self.latencies, self.items, self.failures)
+
+
+def make_queries(corpus, num_queries, seed):
+    """_从语料中截取片段并打乱局部字符作为问题_"""
+    rng = random.Random(seed)
+    chunks = [chunk for chunks in corpus.values() for chunk in chunks]
+    queries = []
+    for _ in range(num_queries):
+        text = rng.choice(chunks).sentence
+        start = rng.randint(0, max(len(text) - 30, 0))
+        query = list(text[start:start + 30])
+        for _ in range(3):
+            query[rng.randrange(len(query))] = rng.choice(_CHARS)
+        queries.append("".join(query))
+    return queries
+
+
+def run(args):
+    module = load_module(args.module)
+    callback = CallbackStub()
+    module.tools.get_callback_request = callback
+    if args.insert_batch:
+        module.mcfg.MILVUS_INSERT_BATCH = args.insert_batch
+    quiet = not args.verbose
+    db_path = tempfile.mkdtemp(prefix="bench_chroma_")
+    embedder = FakeEmbedder(dim=args.dim, seed=args.seed)
+    milvus_kwargs = json.loads(args.milvus_kwargs)
+    results = {}
+    try:
+        milvus = module.MyMilvus(db_path, embedder, **milvus_kwargs)
+        collection_name = "bench"
+        timed(milvus.create_collection, collection_name, quiet=quiet)
+        corpus = generate_corpus(args.chunks, args.min_chunks_per_file,
+                                 args.max_chunks_per_file, args.seed)
+        files = list(corpus)
+        print(f"corpus: {args.chunks} chunks in {len(files)} files")
+
+        # 入库(add_document成功时也返回None,只按traceback判断失败)
+        measurement = Measurement()
+        for file in files:
+            measurement.add(timed(milvus.add_document,
+                                  corpus[file],
+                                  collection_name,
+                                  "http://callback.invalid",
+                                  {"progress": 0},
+                                  quiet=quiet,
+                                  expect_result=False),
+                            items=len(corpus[file]))
+        results["add_document"] = measurement.summary()
+        print(f"add_document: "
+              f"{results['add_document'].get('throughput_per_s') or 0:.1f} "
+              f"chunks/s, {measurement.failures} failed")
+
+        queries = make_queries(corpus, args.queries, args.seed)
+        # 混合检索的BM25索引在后台构建,等待完成后再计时
+        if getattr(milvus, "hybrid_search", False):
+            timed(milvus.load_lexical_index, collection_name, quiet=quiet)
+        # 预热
+        for query in queries[:5]:
+            timed(milvus.similarity_query_hybrid_search,
+                  collection_name,
+                  query,
+                  args.limit,
+                  quiet=quiet)
+
+        measurement = Measurement()
+        for query in queries:
+            measurement.add(
+                timed(milvus.similarity_query_hybrid_search,
+                      collection_name,
+                      query,
+                      args.limit,
+                      quiet=quiet))
+        results["similarity_query_hybrid_search"] = measurement.summary()
+
+        filter_expr = {"is_title": {"$ne": 1}}
+        for context_num in range(0, 6):
+            measurement = Measurement()
+            for query in queries:
+                measurement.add(
+                    timed(milvus.similarity_filter_hybrid_search,
+                          collection_name,
+                          query,
+                          filter_expr,
+                          args.limit,
+                          context_num,
+                          quiet=quiet))
+            results[
+                f"similarity_filter_hybrid_search[context_num={context_num}]"] = measurement.summary(
+                )
+
+        rng = random.Random(args.seed)
+        measurement = Measurement()
+        for _ in range(args.file_list_rounds):
+            file_list = rng.sample(files, min(args.file_list_size, len(files)))
+            measurement.add(timed(milvus.query_by_file_list,
+                                  collection_name,
+                                  file_list,
+                                  quiet=quiet),
+                            items=len(file_list))
+        results["query_by_file_list"] = measurement.summary()
+
+        # 删除:一部分文件逐个删除,另一部分(如有)批量删除
+        delete_files = files[:max(len(files) // 10, 1)]
+        half = len(delete_files) // 2
+        measurement = Measurement()
+        for file in delete_files[half:]:
+            measurement.add(
+                timed(milvus.delete_document_milvus,
+                      collection_name,
+                      file,
+                      quiet=quiet,
+                      expect_result=False))
+        results["delete_document_milvus"] = measurement.summary()
+        if half and hasattr(milvus, "delete_documents"):
+            measurement = Measurement()
+            measurement.add(timed(milvus.delete_documents,
+                                  collection_name,
+                                  delete_files[:half],
+                                  quiet=quiet),
+                            items=half)
+            results["delete_documents"] = measurement.summary()
+
+        timed(milvus.delete_milvus_table, collection_name, quiet=quiet)
+    finally:
+        if args.keep:
+            print(f"database kept at {db_path}")
+        else:
+            shutil.rmtree(db_path, ignore_errors=True)
+
+    report = {
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline")
+        },
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "encode_calls": embedder.encode_calls,
+        "encoded_texts": embedder.encoded_texts,
+        "callback_calls": callback.calls,
+        "failures": sum(
+            stats.get("failures", 0) for stats in results.values()),
+        "results": results
+    }
+    return report
+
+
+def print_report(report, baseline=None):
+    base_results = (baseline or {}).get("results", {})
+    print(f"{'operation':<52}{'count':>7}{'failed':>8}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'items/s':>12}{'vs base p50':>13}")
+    for name, stats in report["results"].items():
+        failures = stats.get("failures", 0)
+        if not stats.get("count"):
+            if failures:
+                print(f"{name:<52}{0:>7}{failures:>8}  all calls failed")
+            continue
+        compare = ""
+        base = base_results.get(name)
+        if base and base.get("p50_ms"):
+            compare = f"{stats['p50_ms'] / base['p50_ms']:.2f}x"
+        throughput = stats["throughput_per_s"] or 0
+        print(f"{name:<52}{stats['count']:>7}{failures:>8}"
+              f"{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{throughput:>12.1f}{compare:>13}")
+    if report.get("failures"):
+        print(f"WARNING: {report['failures']} calls failed and were excluded "
+              f"from the latency percentiles (rerun with --verbose)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--module",
+                        default=None,
+                        help="my_chromadb模块的完整路径,如yourpkg.my_chromadb")
+    parser.add_argument("--chunks", type=int, default=10000, help="片段总数")
+    parser.add_argument("--min-chunks-per-file", type=int, default=20)
+    parser.add_argument("--max-chunks-per-file", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=5, help="每次检索返回条数")
+    parser.add_argument("--file-list-size", type=int, default=50)
+    parser.add_argument("--file-list-rounds", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=256, help="假向量维度")
+    parser.add_argument("--insert-batch",
+                        type=int,
+                        default=None,
+                        help="覆盖mcfg.MILVUS_INSERT_BATCH")
+    parser.add_argument("--milvus-kwargs",
+                        default="{}",
+                        help="传给MyMilvus的其他参数(JSON)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output",
+                        default=None,
+                        help="结果JSON路径,默认benchmarks/results/<时间>.json")
+    parser.add_argument("--baseline", default=None, help="用于对比的历史结果JSON")
+    parser.add_argument("--keep", action="store_true", help="保留临时数据库目录")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        help="显示MyMilvus的输出")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results",
+        time.strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   my_async_chromadb.py
+@Version :   1.0
+@Desc    :   chroma向量数据库封装的asyncio接口
+'''
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .my_chromadb import MyMilvus
+
+
+class _BoundedEmbeddings:
+    """_限制向量化模型同时执行encode的线程数,避免模型被过度并发调用_"""
+
+    def __init__(self, embeddings, max_concurrency):
+        self._embeddings = embeddings
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def encode(self, *args, **kwargs):
+        with self._semaphore:
+            return self._embeddings.encode(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
+
+
+class AsyncMyMilvus:
+    """_MyMilvus的asyncio封装,所有阻塞操作都在有界线程池中执行_"""
+
+    def __init__(self, milvus: MyMilvus, max_workers=8, encode_concurrency=1):
+        """_初始化_
+        Args:
+            milvus (_MyMilvus_): _被封装的MyMilvus实例_
+            max_workers (int, optional): _线程池大小,同时执行的操作数_. Defaults to 8.
+            encode_concurrency (int, optional): _同时向量化的线程数_. Defaults to 1.
+        """
+        self.milvus = milvus
+        if not isinstance(milvus.embeddings, _BoundedEmbeddings):
+            milvus.embeddings = _BoundedEmbeddings(milvus.embeddings,
+                                                   encode_concurrency)
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="my_milvus")
+        # 在事件循环中排队,而不是在线程池队列中排队,取消时不会留下待执行任务
+        self._slots = None
+
+    async def _run(self, func, *args, **kwargs):
+        """_在线程池中执行阻塞函数_
+        等待期间被取消时任务不会再执行;已开始执行的任务会在后台跑完,
+        其占用的并发名额在执行结束后才释放
+        """
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        await self._slots.acquire()
+        try:
+            future = self._executor.submit(
+                functools.partial(func, *args, **kwargs))
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._slots.release))
+        return await asyncio.wrap_future(future)
+
+    async def similarity_query_hybrid_search(self,
+                                             collection_name,
+                                             query,
+                                             limit_num=1,
+                                             **kwargs):
+        return await self._run(self.milvus.similarity_query_hybrid_search,
+                               collection_name, query, limit_num, **kwargs)
+
+    async def similarity_filter_hybrid_search(self,
+                                              collection_name,
+                                              query,
+                                              filter_expr,
+                                              limit_num=1,
+                                              context_num=2,
+                                              **kwargs):
+        return await self._run(self.milvus.similarity_filter_hybrid_search,
+                               collection_name, query, filter_expr, limit_num,
+                               context_num, **kwargs)
+
+    async def similarity_query_batch(self, collection_name, queries,
+                                     **kwargs):
+        return await self._run(self.milvus.similarity_query_batch,
+                               collection_name, queries, **kwargs)
+
+    async def add_document(self, docs, collection_name, file_post_url,
+                           send_msg, **kwargs):
+        """_异步入库_
+        注意:入库开始后被取消不会回滚已写入的批次
+        """
+        return await self._run(self.milvus.add_document, docs,
+                               collection_name, file_post_url, send_msg,
+                               **kwargs)
+
+    async def add_document_stream(self, collection_name, chunk_iter,
+                                  **kwargs):
+        """_异步流式入库,chunk_iter在线程池中被逐批读取_"""
+        return await self._run(self.milvus.add_document_stream,
+                               collection_name, chunk_iter, **kwargs)
+
+    async def sync_document(self, collection_name, docs, **kwargs):
+        return await self._run(self.milvus.sync_document, collection_name,
+                               docs, **kwargs)
+
+    async def query_by_file(self, collection_name, file_name):
+        return await self._run(self.milvus.query_by_file, collection_name,
+                               file_name)
+
+    async def query_by_file_list(self, collection_name, file_name_list,
+                                 **kwargs):
+        return await self._run(self.milvus.query_by_file_list,
+                               collection_name, file_name_list, **kwargs)
+
+    async def delete_document_milvus(self, collection_name, file_name):
+        return await self._run(self.milvus.delete_document_milvus,
+                               collection_name, file_name)
+
+    async def delete_documents(self, collection_name, file_names):
+        return await self._run(self.milvus.delete_documents, collection_name,
+                               file_names)
+
+    async def delete_milvus_table(self, collection_name):
+        return await self._run(self.milvus.delete_milvus_table,
+                               collection_name)
+
+    def close(self, wait=True):
+        """_关闭线程池,未开始的任务被取消_"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close(wait=False)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   my_bm25.py
+@Version :   1.0
+@Desc    :   进程内BM25倒排索引,用于与向量检索做混合检索
+
+中文分词建议安装jieba(pip install jieba):未安装时中文按单字+相邻双字切分,
+常用字的倒排表很长,百万级片段时索引构建与内存占用明显增大
+'''
+import math
+import os
+import pickle
+import re
+import threading
+from array import array
+import numpy as np
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+# 英文/数字词,保留产品型号、条款号中的连接符,如 A-123、3.2.1
+_WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*")
+# 连续的中日韩字符
+_CJK_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+
+
+def tokenizer_name():
+    return "jieba" if jieba is not None else "cjk_bigram"
+
+
+def tokenize(text, for_query=False):
+    """_分词_
+    安装了jieba时使用jieba搜索引擎模式分词,否则中文按单字+相邻双字切分;
+    英文数字按词切分并转小写
+    Args:
+        text (_str_): _文本_
+        for_query (bool, optional): _是否为问题分词,未安装jieba时问题中两个字以上的中文只取双字,
+            不查单字很长的倒排表_. Defaults to False.
+    Returns:
+        _list_: _词列表_
+    """
+    text = text.lower()
+    tokens = _WORD_PATTERN.findall(text)
+    for run in _CJK_PATTERN.findall(text):
+        if jieba is not None:
+            tokens += [word for word in jieba.lcut_for_search(run)]
+        else:
+            if not for_query or len(run) == 1:
+                tokens += list(run)
+            tokens += [run[i:i + 2] for i in range(len(run) - 1)]
+    return tokens
+
+
+class BM25Index:
+    """_BM25倒排索引_
+    每个词的倒排表是两个紧凑的int32数组(文档号, 词频);删除采用标记删除,
+    已删除文档超过一定比例时重建倒排表
+    """
+
+    # 已删除文档占比超过该值时压缩索引
+    compact_ratio = 0.2
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer_name()
+        # 内部文档号 -> chroma id / 文件名
+        self.ids = []
+        self.files = []
+        self.doc_lens = array('i')
+        self.alive = bytearray()
+        # 词 -> (文档号数组, 词频数组)
+        self.postings = {}
+        self.file_docs = {}
+        self.num_alive = 0
+        self.total_len = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.num_alive
+
+    def add(self, ids, documents, metadatas):
+        """_添加文档_
+        Args:
+            ids (_list_): _chroma id列表_
+            documents (_list_): _文本列表_
+            metadatas (_list_): _metadatas列表,需要file字段_
+        """
+        with self._lock:
+            for id_item, document, metadata in zip(ids, documents,
+                                                   metadatas):
+                doc_num = len(self.ids)
+                tokens = tokenize(document)
+                term_freqs = {}
+                for token in tokens:
+                    term_freqs[token] = term_freqs.get(token, 0) + 1
+                for term, freq in term_freqs.items():
+                    posting = self.postings.get(term)
+                    if posting is None:
+                        posting = self.postings[term] = (array('i'),
+                                                         array('i'))
+                    posting[0].append(doc_num)
+                    posting[1].append(freq)
+                self.ids.append(id_item)
+                self.files.append(metadata['file'])
+                self.doc_lens.append(len(tokens))
+                self.alive.append(1)
+                self.file_docs.setdefault(metadata['file'], []).append(doc_num)
+                self.num_alive += 1
+                self.total_len += len(tokens)
+
+    def remove_files(self, files):
+        """_删除若干文件的所有文档_"""
+        with self._lock:
+            for file in files:
+                for doc_num in self.file_docs.pop(file, ()):
+                    if self.alive[doc_num]:
+                        self.alive[doc_num] = 0
+                        self.num_alive -= 1
+                        self.total_len -= self.doc_lens[doc_num]
+            if len(self.ids) - self.num_alive > self.compact_ratio * len(
+                    self.ids):
+                self.compact()
+
+    def compact(self):
+        """_去掉已删除的文档,重新编号并重建倒排表_"""
+        with self._lock:
+            remap = array('i', [-1]) * len(self.ids)
+            ids, files, doc_lens, file_docs = [], [], array('i'), {}
+            for doc_num, is_alive in enumerate(self.alive):
+                if is_alive:
+                    remap[doc_num] = len(ids)
+                    ids.append(self.ids[doc_num])
+                    files.append(self.files[doc_num])
+                    doc_lens.append(self.doc_lens[doc_num])
+                    file_docs.setdefault(self.files[doc_num],
+                                         []).append(len(ids) - 1)
+            postings = {}
+            for term, (doc_nums, freqs) in self.postings.items():
+                new_docs, new_freqs = array('i'), array('i')
+                for doc_num, freq in zip(doc_nums, freqs):
+                    if remap[doc_num] >= 0:
+                        new_docs.append(remap[doc_num])
+                        new_freqs.append(freq)
+                if new_docs:
+                    postings[term] = (new_docs, new_freqs)
+            self.ids, self.files, self.doc_lens = ids, files, doc_lens
+            self.alive = bytearray(b"\x01") * len(ids)
+            self.postings = postings
+            self.file_docs = file_docs
+
+    def max_score(self, query):
+        """_问题可能得到的最高BM25得分(每个词的词频项取上限k1+1),用于把得分归一化到[0, 1)_
+        语料中没有的词按文档频率0计算idf,问题中未命中的词越多归一化得分越低
+        """
+        with self._lock:
+            total = 0
+            for term in set(tokenize(query, for_query=True)):
+                posting = self.postings.get(term)
+                doc_freq = len(posting[0]) if posting is not None else 0
+                total += math.log(1 + (self.num_alive - doc_freq + 0.5) /
+                                  (doc_freq + 0.5)) * (self.k1 + 1)
+            return total
+
+    def search(self, query, top_k):
+        """_检索_
+        Args:
+            query (_str_): _问题文本_
+            top_k (_int_): _返回条数_
+        Returns:
+            _list_: _[(chroma id, 文件名, 得分)],按得分降序_
+        """
+        with self._lock:
+            if not self.num_alive:
+                return []
+            terms = [
+                term for term in set(tokenize(query, for_query=True))
+                if term in self.postings
+            ]
+            if not terms:
+                return []
+            scores = np.zeros(len(self.ids), dtype=np.float32)
+            doc_lens = np.frombuffer(self.doc_lens, dtype=np.int32)
+            avg_len = self.total_len / self.num_alive
+            for term in terms:
+                doc_nums = np.frombuffer(self.postings[term][0],
+                                         dtype=np.int32)
+                freqs = np.frombuffer(self.postings[term][1],
+                                      dtype=np.int32).astype(np.float32)
+                # 未压缩前的文档频率包含已删除文档,是近似值
+                doc_freq = len(doc_nums)
+                idf = math.log(1 + (self.num_alive - doc_freq + 0.5) /
+                               (doc_freq + 0.5))
+                norm = self.k1 * (1 - self.b +
+                                  self.b * doc_lens[doc_nums] / avg_len)
+                scores[doc_nums] += idf * freqs * (self.k1 + 1) / (freqs +
+                                                                   norm)
+                del doc_nums, freqs
+            scores *= np.frombuffer(self.alive, dtype=np.uint8)
+            top_k = min(top_k, int(np.count_nonzero(scores)))
+            if top_k <= 0:
+                return []
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.ids[doc_num], self.files[doc_num],
+                     float(scores[doc_num])) for doc_num in top]
+
+    def save(self, path):
+        """_保存到文件(先写临时文件再替换)_"""
+        with self._lock:
+            state = {
+                "k1": self.k1,
+                "b": self.b,
+                "tokenizer": self.tokenizer,
+                "ids": self.ids,
+                "files": self.files,
+                "doc_lens": self.doc_lens,
+                "alive": self.alive,
+                "postings": self.postings,
+                "num_alive": self.num_alive,
+                "total_len": self.total_len
+            }
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """_从文件加载,分词方式与当前环境不一致时返回None(需要重建)_"""
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state["tokenizer"] != tokenizer_name():
+            return None
+        index = cls(state["k1"], state["b"])
+        for key in ("ids", "files", "doc_lens", "alive", "postings",
+                    "num_alive", "total_len"):
+            setattr(index, key, state[key])
+        for doc_num, file in enumerate(index.files):
+            if index.alive[doc_num]:
+                index.file_docs.setdefault(file, []).append(doc_num)
+        return index
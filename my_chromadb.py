@@ -8,36 +8,987 @@
 @Desc    :   chroma向量数据库封装
 '''
 import chromadb
+import contextvars
+import hashlib
+import itertools
+import json
 import math
+import numpy as np
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
 import uuid
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List
 from .utils import tools, message_format
+from .my_bm25 import BM25Index, tokenizer_name
+from .my_metrics import (Histogram, InMemoryMetrics, Instrumentation,
+                         MetricsSink, NULL_INSTRUMENTATION, instrumented)
 from .configs import model_config as mcfg
 import traceback
 
 
+# 结果文本中需要去掉的特殊字符
+_CLEAN_TABLE = str.maketrans("", "", "\xa0\n")
+
+
+class SearchResult:
+    """_检索结果项_
+    支持按键读写(res['sentence']),to_dict()转换为原有的字典结构
+    """
+    __slots__ = ('id', 'sentence', 'key_sentence', 'is_title', 'is_head',
+                 'level', 'outline', 'index', 'file', 'distance')
+
+    def __init__(self, id, sentence, key_sentence, metadata, distance):
+        self.id = id
+        self.sentence = sentence
+        # 有过滤条件的查询没有key_sentence
+        self.key_sentence = key_sentence
+        self.is_title = metadata['is_title']
+        self.is_head = metadata['is_head']
+        self.level = metadata['level']
+        self.outline = metadata['outline']
+        self.index = metadata['index']
+        self.file = metadata['file']
+        self.distance = distance
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __repr__(self):
+        return f"SearchResult({self.to_dict()!r})"
+
+    def copy(self):
+        new = SearchResult.__new__(SearchResult)
+        for name in self.__slots__:
+            setattr(new, name, getattr(self, name))
+        return new
+
+    def to_dict(self):
+        result_item = {'id': self.id, 'sentence': self.sentence}
+        if self.key_sentence is not None:
+            result_item['key_sentence'] = self.key_sentence
+        result_item['is_title'] = self.is_title
+        result_item['is_head'] = self.is_head
+        result_item['level'] = self.level
+        result_item['outline'] = self.outline
+        result_item['index'] = self.index
+        result_item['file'] = self.file
+        result_item['distance'] = self.distance
+        return result_item
+
+
+class _ChunkLayout:
+    """_单个文件的片段布局,按index排序的紧凑数组_"""
+    __slots__ = ('indexes', 'levels', 'documents', 'nbytes')
+
+    def __init__(self, metadatas, documents):
+        order = sorted(range(len(metadatas)),
+                       key=lambda i: int(metadatas[i]['index']))
+        self.indexes = array('l', (int(metadatas[i]['index']) for i in order))
+        self.levels = array('l', (int(metadatas[i]['level']) for i in order))
+        self.documents = tuple(documents[i] for i in order)
+        self.nbytes = (self.indexes.itemsize * len(self.indexes) +
+                       self.levels.itemsize * len(self.levels) +
+                       sum(sys.getsizeof(doc) for doc in self.documents))
+
+    def get(self, index):
+        """_按index二分查找片段_
+        Returns:
+            _tuple_: _(level, document),不存在时返回None_
+        """
+        pos = bisect_left(self.indexes, index)
+        if pos < len(self.indexes) and self.indexes[pos] == index:
+            return self.levels[pos], self.documents[pos]
+        return None
+
+
+class _ChunkLayoutCache:
+    """_(collection_name, file) -> _ChunkLayout 的LRU缓存,按字节预算淘汰_
+    每个文件(及集合)有一个代数,失效时+1;读取chroma前记下代数,
+    写入缓存时代数已变化说明读取期间数据被修改,不写入。
+    无法缓存的文件(超过预算,或读取期间被修改)记录在_bypass中,
+    之后按需取回相邻片段,不再整份拉取
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._generations = {}
+        self._collection_generations = {}
+        # key -> (代数, 是否超过预算)
+        self._bypass = {}
+        self._lock = threading.Lock()
+
+    def _generation(self, key):
+        return (self._collection_generations.get(key[0], 0),
+                self._generations.get(key, 0))
+
+    def generation(self, key):
+        """_读取chroma之前调用,put时传入_"""
+        with self._lock:
+            return self._generation(key)
+
+    def cacheable(self, key):
+        """_是否值得整份拉取文件写入缓存_
+        超过预算的文件在数据变化前不再尝试;读取期间被修改的文件,
+        在两次查询之间没有再被修改前不再尝试
+        """
+        with self._lock:
+            entry = self._bypass.get(key)
+            if entry is None:
+                return True
+            generation, oversized = entry
+            current = self._generation(key)
+            if oversized:
+                if generation == current:
+                    return False
+            elif generation != current:
+                self._bypass[key] = (current, False)
+                return False
+            del self._bypass[key]
+            return True
+
+    def get(self, key):
+        with self._lock:
+            layout = self._data.get(key)
+            if layout is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return layout
+
+    def put(self, key, layout, generation=None):
+        """_写入缓存_
+        Returns:
+            _bool_: _是否写入;超过预算或读取期间数据被修改时不写入,并记录到_bypass_
+        """
+        with self._lock:
+            current = self._generation(key)
+            if generation is not None and generation != current:
+                self._bypass[key] = (current, False)
+                return False
+            # 超过预算的单个文件不缓存
+            if layout.nbytes > self.max_bytes:
+                self._bypass[key] = (current, True)
+                return False
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+            self._data[key] = layout
+            self.current_bytes += layout.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+            return True
+
+    def invalidate(self, collection_name, file):
+        key = (collection_name, file)
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.nbytes
+
+    def invalidate_collection(self, collection_name):
+        with self._lock:
+            # 集合代数变化后各文件的代数不再需要
+            self._collection_generations[collection_name] = (
+                self._collection_generations.get(collection_name, 0) + 1)
+            for key in [
+                    k for k in self._generations if k[0] == collection_name
+            ]:
+                del self._generations[key]
+            for key in [k for k in self._data if k[0] == collection_name]:
+                self.current_bytes -= self._data.pop(key).nbytes
+            for key in [
+                    k for k in self._bypass if k[0] == collection_name
+            ]:
+                del self._bypass[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._data),
+                "bypassed": len(self._bypass),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+class _EmbeddingCache:
+    """_持久化的向量缓存,按(模型标识, 文本)的哈希保存float32向量_"""
+
+    # 单条SQL中IN参数的最大数量
+    query_chunk_size = 500
+
+    def __init__(self, db_path, model_id):
+        self.model_id = model_id
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embedding_cache "
+                           "(key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def make_key(self, text):
+        return hashlib.sha1(
+            (self.model_id + "\x00" + text).encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """_批量读取向量_
+        Returns:
+            _dict_: _{key: np.ndarray}_
+        """
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            for start in range(0, len(keys), self.query_chunk_size):
+                chunk = keys[start:start + self.query_chunk_size]
+                rows = self._conn.execute(
+                    "SELECT key, vector FROM embedding_cache WHERE key IN "
+                    f"({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        """_批量写入向量_
+        Args:
+            items (_list_): _[(key, vector)]_
+        """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector) "
+                "VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes())
+                 for key, vector in items])
+            self._conn.commit()
+
+
+class _VectorTransform:
+    """_集合的向量降维方式,入库与查询时自动应用_
+    truncate: 直接截取前dim维(适用于Matryoshka类模型);
+    pca: 首次入库时用样本向量拟合一次PCA投影
+    """
+
+    def __init__(self, kind, dim, keep_full):
+        if kind not in ("truncate", "pca"):
+            raise Exception(f'不支持的向量变换: {kind}')
+        self.kind = kind
+        self.dim = int(dim)
+        self.keep_full = bool(keep_full)
+        self.full_dim = None
+        self.mean = None
+        self.components = None
+
+    @property
+    def fitted(self):
+        return self.full_dim is not None
+
+    def fit(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        full_dim = vectors.shape[1]
+        if self.dim >= full_dim:
+            raise Exception(f'降维后的维度{self.dim}需小于原始维度{full_dim}')
+        if self.kind == "pca":
+            if len(vectors) < self.dim:
+                raise Exception(f'PCA降维至少需要{self.dim}条片段拟合,当前{len(vectors)}条')
+            self.mean = vectors.mean(axis=0)
+            _, _, vt = np.linalg.svd(vectors - self.mean, full_matrices=False)
+            self.components = vt[:self.dim].astype(np.float32)
+        # 最后设置full_dim,其他线程看到fitted时参数已完整
+        self.full_dim = full_dim
+
+    def apply(self, vectors):
+        """_降维并重新归一化(内积空间)_"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.kind == "truncate":
+            reduced = vectors[:, :self.dim]
+        else:
+            reduced = (vectors - self.mean) @ self.components.T
+        norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+        return reduced / np.maximum(norms, 1e-12)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {"full_dim": np.asarray(self.full_dim)}
+        if self.kind == "pca":
+            arrays["mean"] = self.mean
+            arrays["components"] = self.components
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    def load(self, path):
+        with np.load(path) as data:
+            self.full_dim = int(data["full_dim"])
+            if self.kind == "pca":
+                self.mean = data["mean"]
+                self.components = data["components"]
+
+
+class _FullVectorStore:
+    """_降维集合的原始向量(float16)旁路存储,用于重打分与召回率评估_"""
+
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS full_vectors (collection TEXT, "
+            "id TEXT, file TEXT, vector BLOB NOT NULL, "
+            "PRIMARY KEY (collection, id))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS full_vectors_file "
+                           "ON full_vectors (collection, file)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def put_many(self, collection_name, ids, files, vectors):
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO full_vectors "
+                "(collection, id, file, vector) VALUES (?, ?, ?, ?)",
+                [(collection_name, id_item, file, vector.tobytes())
+                 for id_item, file, vector in zip(ids, files, vectors)])
+            self._conn.commit()
+
+    def get_many(self, collection_name, ids):
+        found = {}
+        ids = list(ids)
+        with self._lock:
+            for start in range(0, len(ids), _EmbeddingCache.query_chunk_size):
+                chunk = ids[start:start + _EmbeddingCache.query_chunk_size]
+                rows = self._conn.execute(
+                    "SELECT id, vector FROM full_vectors WHERE collection = ? "
+                    f"AND id IN ({','.join('?' * len(chunk))})",
+                    [collection_name] + chunk).fetchall()
+                for id_item, blob in rows:
+                    found[id_item] = np.frombuffer(blob, dtype=np.float16)
+        return found
+
+    def prune_files(self, collection_name, files, keep_ids):
+        """_删除这些文件中已不在chroma中的向量_"""
+        files = list(files)
+        with self._lock:
+            rows = []
+            for start in range(0, len(files), _EmbeddingCache.query_chunk_size):
+                chunk = files[start:start + _EmbeddingCache.query_chunk_size]
+                rows += self._conn.execute(
+                    "SELECT id FROM full_vectors WHERE collection = ? "
+                    f"AND file IN ({','.join('?' * len(chunk))})",
+                    [collection_name] + chunk).fetchall()
+            self._conn.executemany(
+                "DELETE FROM full_vectors WHERE collection = ? AND id = ?",
+                [(collection_name, id_item) for id_item, in rows
+                 if id_item not in keep_ids])
+            self._conn.commit()
+
+    def drop_collection(self, collection_name):
+        with self._lock:
+            self._conn.execute("DELETE FROM full_vectors WHERE collection = ?",
+                               (collection_name, ))
+            self._conn.commit()
+
+    def count(self, collection_name):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM full_vectors WHERE collection = ?",
+                (collection_name, )).fetchone()[0]
+
+    def iter_batches(self, collection_name, batch_size=10000):
+        """_分批遍历集合的全部原始向量_
+        Returns:
+            _generator_: _(id列表, float32矩阵)_
+        """
+        last_id = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, vector FROM full_vectors WHERE collection = ? "
+                    "AND id > ? ORDER BY id LIMIT ?",
+                    (collection_name, last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [row[0] for row in rows], np.vstack([
+                np.frombuffer(row[1], dtype=np.float16) for row in rows
+            ]).astype(np.float32)
+
+
+class _QueryEncodeBatcher:
+    """_问题向量化的微批调度器_
+    在window_ms时间窗口内(或攒够max_batch_size条)到达的问题合并为一次encode,
+    每个调用方拿回自己的向量
+    """
+
+    def __init__(self, encode_func, window_ms, max_batch_size):
+        self.encode_func = encode_func
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batch_size_histogram = Histogram((1, 2, 4, 8, 16, 32, 64, 128))
+        self.queue_wait_ms_histogram = Histogram(
+            (0.5, 1, 2, 5, 10, 20, 50, 100))
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def encode(self, text):
+        """_提交一个问题并等待其向量_"""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run,
+                                                    daemon=True)
+                    self._thread.start()
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            start = time.perf_counter()
+            self.batch_size_histogram.observe(len(batch))
+            for _, _, enqueued in batch:
+                self.queue_wait_ms_histogram.observe(
+                    (start - enqueued) * 1000)
+            try:
+                vectors = self.encode_func([text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        return {
+            "batch_size": self.batch_size_histogram.snapshot(),
+            "queue_wait_ms": self.queue_wait_ms_histogram.snapshot()
+        }
+
+
+class _QueryResultCache:
+    """_查询结果的LRU/TTL缓存,条目记录写入时的集合版本号,版本变化即失效_"""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _copy(result_list):
+        # 结果项可变(字典或SearchResult),缓存内外各持一份
+        return [item.copy() for item in result_list]
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, entry_version, result_list = entry
+                if entry_version == version and expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return self._copy(result_list)
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, version, result_list):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, version,
+                               self._copy(result_list))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._data),
+                "max_entries": self.max_entries
+            }
+
+
+def _shard_of(file, num_shards):
+    """_文件所在的分片,同一文件的所有片段在同一分片中_"""
+    return zlib.crc32(str(file).encode("utf-8")) % num_shards
+
+
+class _ShardedCollection:
+    """_逻辑集合,按文件名哈希分布在多个PersistentClient的同名集合中_
+    实现本模块用到的chroma Collection接口,写入按file路由,
+    查询并行发往各分片后按距离合并
+    """
+
+    def __init__(self, name, shards, pool):
+        self.name = name
+        self.shards = shards
+        self._pool = pool
+
+    @property
+    def metadata(self):
+        return self.shards[0].metadata
+
+    def count(self):
+        return sum(self._pool.map(lambda shard: shard.count(), self.shards))
+
+    def _route_where(self, where):
+        """_按where中的file条件确定需要访问的分片_
+        Returns:
+            _dict_: _{分片号: 该分片使用的where}_
+        """
+        num_shards = len(self.shards)
+        file_cond = (where or {}).get("file")
+        if isinstance(file_cond, dict):
+            if "$eq" in file_cond:
+                return {_shard_of(file_cond["$eq"], num_shards): where}
+            if "$in" in file_cond:
+                grouped = {}
+                for file in file_cond["$in"]:
+                    grouped.setdefault(_shard_of(file, num_shards),
+                                       []).append(file)
+                return {
+                    shard: dict(where, file={"$in": files})
+                    for shard, files in grouped.items()
+                }
+        if where and "$and" in where:
+            for clause in where["$and"]:
+                routed = self._route_where(clause)
+                if len(routed) == 1 and "file" in clause:
+                    return {next(iter(routed)): where}
+        if where and "$or" in where:
+            grouped = {}
+            for clause in where["$or"]:
+                routed = self._route_where(clause)
+                if len(routed) != 1:
+                    break
+                grouped.setdefault(next(iter(routed)), []).append(clause)
+            else:
+                return {
+                    shard: clauses[0] if len(clauses) == 1 else {
+                        "$or": clauses
+                    }
+                    for shard, clauses in grouped.items()
+                }
+        return {shard: where for shard in range(num_shards)}
+
+    def _write(self, method, ids, documents, embeddings, metadatas):
+        grouped = {}
+        for position, metadata in enumerate(metadatas):
+            grouped.setdefault(_shard_of(metadata['file'], len(self.shards)),
+                               []).append(position)
+        for shard, positions in grouped.items():
+            getattr(self.shards[shard], method)(
+                ids=[ids[i] for i in positions],
+                documents=[documents[i] for i in positions],
+                embeddings=np.asarray(embeddings)[positions],
+                metadatas=[metadatas[i] for i in positions])
+
+    def add(self, ids, documents, embeddings, metadatas):
+        self._write("add", ids, documents, embeddings, metadatas)
+
+    def upsert(self, ids, documents, embeddings, metadatas):
+        self._write("upsert", ids, documents, embeddings, metadatas)
+
+    def delete(self, ids=None, where=None):
+        # 只按id删除时无法确定分片,发往所有分片
+        routed = self._route_where(where) if where else {
+            shard: None
+            for shard in range(len(self.shards))
+        }
+        list(
+            self._pool.map(
+                lambda item: self.shards[item[0]].delete(ids=ids,
+                                                         where=item[1]),
+                routed.items()))
+
+    def get(self,
+            ids=None,
+            where=None,
+            include=None,
+            limit=None,
+            offset=None):
+        # chroma要求include为list
+        include = ["documents", "metadatas"] if include is None else list(
+            include)
+        if limit is not None or offset:
+            # 分页按分片顺序依次读取(只用于全量遍历,不带where)
+            return self._get_paged(ids, where, include, limit, offset or 0)
+        routed = self._route_where(where)
+        results = list(
+            self._pool.map(
+                lambda item: self.shards[item[0]].get(
+                    ids=ids, where=item[1], include=include), routed.items()))
+        merged = {"ids": []}
+        for key in include:
+            merged[key] = []
+        for r in results:
+            merged["ids"] += r["ids"]
+            for key in include:
+                merged[key] += list(r[key])
+        return merged
+
+    def _get_paged(self, ids, where, include, limit, offset):
+        merged = {"ids": []}
+        for key in include:
+            merged[key] = []
+        for shard in self.shards:
+            if limit is not None and len(merged["ids"]) >= limit:
+                break
+            shard_count = shard.count()
+            if offset >= shard_count:
+                offset -= shard_count
+                continue
+            remaining = None if limit is None else limit - len(merged["ids"])
+            r = shard.get(ids=ids,
+                          where=where,
+                          include=include,
+                          limit=remaining,
+                          offset=offset)
+            offset = 0
+            merged["ids"] += r["ids"]
+            for key in include:
+                merged[key] += list(r[key])
+        return merged
+
+    def query(self,
+              query_embeddings,
+              n_results=10,
+              where=None,
+              include=None):
+        """_并行查询所有分片,每个问题按距离合并出前n_results条_"""
+        include = ["metadatas", "documents", "distances"
+                   ] if include is None else list(include)
+        if "distances" not in include:
+            include.append("distances")
+        results = list(
+            self._pool.map(
+                lambda shard: shard.query(query_embeddings=query_embeddings,
+                                          n_results=n_results,
+                                          where=where,
+                                          include=include), self.shards))
+        keys = ["ids"] + list(include)
+        merged = {key: [] for key in keys}
+        for query_index in range(len(query_embeddings)):
+            candidates = []
+            for shard_index, r in enumerate(results):
+                for position, distance in enumerate(
+                        r["distances"][query_index]):
+                    candidates.append((distance, shard_index, position))
+            candidates.sort(key=lambda item: item[0])
+            candidates = candidates[:n_results]
+            for key in keys:
+                merged[key].append([
+                    results[shard_index][key][query_index][position]
+                    for _, shard_index, position in candidates
+                ])
+        return merged
+
+
+class _CollectionHandle:
+    """_注册表中缓存的集合句柄_
+    其他进程删除并重建同名集合后,缓存的底层句柄会报"does not exist",
+    此时向chroma重新解析一次并重试;集合确实已被删除时从注册表移除
+    """
+
+    def __init__(self, registry, collection_name, handle):
+        self._registry = registry
+        self._collection_name = collection_name
+        self._handle = handle
+
+    def __getattr__(self, name):
+        attr = getattr(self._handle, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            handle = self._handle
+            try:
+                return getattr(handle, name)(*args, **kwargs)
+            except Exception as e:
+                if 'does not exist' not in str(e):
+                    raise
+                handle = self._registry.reresolve(self._collection_name,
+                                                  self, handle)
+            return getattr(handle, name)(*args, **kwargs)
+
+        return call
+
+
+class _CollectionRegistry:
+    """_集合句柄注册表,按名称缓存get_collection的结果_"""
+
+    def __init__(self, clients, shard_pool=None):
+        self.clients = clients
+        self.shard_pool = shard_pool
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, collection_name, create_metadata=None):
+        """_向chroma解析集合,多分片时组合为逻辑集合_"""
+        if create_metadata is not None:
+            shards = [
+                client.create_collection(name=collection_name,
+                                         metadata=create_metadata)
+                for client in self.clients
+            ]
+        else:
+            shards = [
+                client.get_collection(name=collection_name)
+                for client in self.clients
+            ]
+        if len(shards) == 1:
+            return shards[0]
+        return _ShardedCollection(collection_name, shards, self.shard_pool)
+
+    def get(self, collection_name):
+        """_获取集合句柄,首次访问时向chroma解析一次_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+        Returns:
+            _Collection_: _集合句柄_
+        """
+        handle = self._handles.get(collection_name)
+        if handle is not None:
+            return handle
+        try:
+            handle = self.resolve(collection_name)
+        except Exception:
+            raise Exception(f'{collection_name} has not exsit')
+        with self._lock:
+            return self._handles.setdefault(
+                collection_name,
+                _CollectionHandle(self, collection_name, handle))
+
+    def reresolve(self, collection_name, cached, stale):
+        """_缓存的句柄已失效时重新解析,多个线程同时发现时只解析一次_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            cached (_CollectionHandle_): _注册表中的句柄_
+            stale (_Collection_): _报错的底层句柄_
+        Returns:
+            _Collection_: _新的底层句柄_
+        """
+        with self._lock:
+            if cached._handle is not stale:
+                return cached._handle
+            try:
+                cached._handle = self.resolve(collection_name)
+            except Exception:
+                if self._handles.get(collection_name) is cached:
+                    del self._handles[collection_name]
+                raise Exception(f'{collection_name} has not exsit')
+            return cached._handle
+
+    def put(self, collection_name, handle):
+        with self._lock:
+            self._handles[collection_name] = _CollectionHandle(
+                self, collection_name, handle)
+
+    def drop(self, collection_name):
+        with self._lock:
+            self._handles.pop(collection_name, None)
+
+
 class MyMilvus:
 
-    def __init__(self, db_file_path, embeddings):
+    # 按文件名列表批量查询/删除时,每次请求携带的最大文件数
+    file_filter_chunk_size = 500
+
+    def __init__(self,
+                 db_file_path,
+                 embeddings,
+                 context_cache_bytes=64 * 1024 * 1024,
+                 pipelined_ingest=False,
+                 ingest_queue_size=2,
+                 embedding_cache=False,
+                 embedding_model_id=None,
+                 query_batch_window_ms=0,
+                 query_batch_max_size=32,
+                 result_cache_size=0,
+                 result_cache_ttl=300,
+                 hybrid_search=False,
+                 rrf_k=60,
+                 bm25_min_score=0.2,
+                 lexical_save_interval=30,
+                 similarity_threshold=0.4,
+                 reranker=None,
+                 rerank_overfetch=1,
+                 rerank_time_budget_ms=None,
+                 mmr_lambda=0.7,
+                 rescore_overfetch=2,
+                 pca_fit_samples=10000,
+                 num_shards=1,
+                 metrics=None,
+                 trace_requests=False):
         # 初始化chroma实例
-        self.client = chromadb.PersistentClient(path=db_file_path)
+        # num_shards>1时每个分片是db_file_path/shard_i下独立的PersistentClient,
+        # 片段按文件名哈希分布,查询并行发往各分片
+        # 分片数记录在库目录中,以不同分片数重新打开时报错
+        self._check_num_shards(db_file_path, num_shards)
+        self.num_shards = num_shards
+        if num_shards > 1:
+            self.clients = [
+                chromadb.PersistentClient(
+                    path=os.path.join(db_file_path, f'shard_{shard}'))
+                for shard in range(num_shards)
+            ]
+            self.shard_pool = ThreadPoolExecutor(
+                max_workers=num_shards, thread_name_prefix="chroma_shard")
+        else:
+            self.clients = [chromadb.PersistentClient(path=db_file_path)]
+            self.shard_pool = None
+        self.client = self.clients[0]
         # 向量化
         self.embeddings = embeddings
         # 向量维度(chroma暂不需要设置向量维度，保证入库的向量同维度即可)
         # self.vector_dim = mcfg.VECTOR_DIM
         # 当前选择的空间
         self.collection = None
+        # 已解析的集合句柄,内部按名称取用(_get_collection),不修改self.collection
+        self.collections = _CollectionRegistry(self.clients, self.shard_pool)
+        # 上下文拼接用的文件片段布局缓存(context_cache_bytes<=0表示不缓存)
+        self.context_cache = _ChunkLayoutCache(
+            context_cache_bytes) if context_cache_bytes > 0 else None
+        # 流水线入库:向量化下一批的同时写入当前批,回调在后台线程发送
+        self.pipelined_ingest = pipelined_ingest
+        # 流水线中各队列的最大积压批数
+        self.ingest_queue_size = ingest_queue_size
+        # 入库向量缓存,相同文本重复导入时跳过向量化
+        # embedding_model_id用于区分不同模型的向量,开启缓存时必须指定,更换模型时需要修改;
+        # 模型提供向量维度时一并作为键的一部分
+        self.embedding_cache = None
+        if embedding_cache:
+            if not embedding_model_id:
+                raise Exception('开启embedding_cache时必须指定embedding_model_id'
+                                '(如模型名称与版本),否则更换模型后会读到旧模型的向量')
+            model_id = str(embedding_model_id)
+            get_dimension = getattr(embeddings,
+                                    'get_sentence_embedding_dimension', None)
+            if callable(get_dimension):
+                model_id += f"\x00dim={get_dimension()}"
+            self.embedding_cache = _EmbeddingCache(
+                os.path.join(db_file_path, 'embedding_cache.sqlite3'),
+                model_id)
+        # 最近一次导入的向量缓存命中统计
+        self.last_import_stats = None
+        # 并发查询时合并问题向量化(query_batch_window_ms<=0表示不合并)
+        self.query_batcher = None
+        if query_batch_window_ms > 0:
+            self.query_batcher = _QueryEncodeBatcher(
+                lambda texts: self.embeddings.encode(
+                    texts, normalize_embeddings=True), query_batch_window_ms,
+                query_batch_max_size)
+        # 查询结果缓存(result_cache_size<=0表示不缓存),集合数据变化时版本号+1
+        self.result_cache = _QueryResultCache(
+            result_cache_size,
+            result_cache_ttl) if result_cache_size > 0 else None
+        self._collection_versions = {}
+        self._versions_lock = threading.Lock()
+        # 混合检索:维护每个集合的BM25索引,查询时与向量结果做RRF融合
+        self.db_file_path = db_file_path
+        self.hybrid_search = hybrid_search
+        self.rrf_k = rrf_k
+        # 只被BM25召回的片段,归一化BM25得分(相对问题可能的最高得分)不低于该值时才不受相似度阈值限制
+        self.bm25_min_score = bm25_min_score
+        self._lexical_indexes = {}
+        self._lexical_lock = threading.Lock()
+        # 后台加载/构建中的BM25索引:collection_name -> {"pending": 构建期间变化的文件, "done": Event}
+        # 构建完成前混合检索只使用向量检索
+        self._lexical_building = {}
+        # BM25索引变化后延迟lexical_save_interval秒落盘,期间的多次变化只保存一次(<=0表示每次变化都保存)
+        # 未保存期间存在.dirty标记文件,进程异常退出后重新打开时据此重建索引
+        self.lexical_save_interval = lexical_save_interval
+        self._lexical_dirty = set()
+        self._lexical_save_timer = None
+        # 返回结果的相似度阈值,不超过该值的结果丢弃
+        self.similarity_threshold = similarity_threshold
+        # 重排:多取rerank_overfetch倍候选,重排后只对最终limit_num条拼接上下文
+        # reranker为带predict(pairs)方法的交叉编码器(同embeddings一样由外部传入),或"mmr"
+        self.reranker = reranker
+        self.rerank_overfetch = rerank_overfetch
+        # 从开始查询到准备重排已超过该耗时(毫秒)时跳过重排,None表示不限制
+        self.rerank_time_budget_ms = rerank_time_budget_ms
+        self.mmr_lambda = mmr_lambda
+        # 降维集合:变换记录在集合metadata中,PCA参数保存在vector_transforms目录
+        # 保留原始向量的集合多取rescore_overfetch倍候选,用原始向量重打分
+        self.rescore_overfetch = rescore_overfetch
+        self.pca_fit_samples = pca_fit_samples
+        self._vector_transforms = {}
+        self._transform_locks = {}
+        self._transform_locks_lock = threading.Lock()
+        self._full_vectors = None
+        self._full_vectors_lock = threading.Lock()
+        # 埋点:metrics为MetricsSink(如InMemoryMetrics)或其列表,None表示不记录
+        # trace_requests为True时每次请求额外生成一条追踪记录(各阶段耗时、计数、错误)
+        if metrics is None:
+            self.metrics = NULL_INSTRUMENTATION
+        else:
+            sinks = [metrics] if isinstance(metrics, MetricsSink) else metrics
+            self.metrics = Instrumentation(sinks, trace=trace_requests)
 
-    def create_collection(self, collection_name):
+    @instrumented
+    def create_collection(self,
+                          collection_name,
+                          vector_dim=None,
+                          vector_transform="truncate",
+                          keep_full_vectors=False):
         """_创建集合_
         Args:
             collection_name (_str_): _集合(空间名称)_
+            vector_dim (_int_, optional): _降维后存入索引的维度_. Defaults to None,不降维.
+            vector_transform (_str_, optional): _降维方式,truncate或pca_. Defaults to "truncate".
+            keep_full_vectors (_bool_, optional): _是否以float16保留原始向量用于重打分_. Defaults to False.
         Returns:
             _None_: _None_
         """
         if not self.check_collection_exist(collection_name):
-            collection = self.client.create_collection(
-                name=collection_name, metadata={"hnsw:space": "ip"})
+            metadata = {"hnsw:space": "ip"}
+            if vector_dim:
+                # 校验参数
+                _VectorTransform(vector_transform, vector_dim,
+                                 keep_full_vectors)
+                metadata["vector:transform"] = vector_transform
+                metadata["vector:dim"] = int(vector_dim)
+                metadata["vector:keep_full"] = int(bool(keep_full_vectors))
+            collection = self.collections.resolve(collection_name,
+                                                  create_metadata=metadata)
+            self.collections.put(collection_name, collection)
+            self._vector_transforms.pop(collection_name, None)
+            # 同名集合在外部被删除时旁路存储可能残留旧向量
+            self._drop_full_vectors(collection_name)
             return collection
         else:
             raise Exception(
@@ -51,12 +1002,647 @@ class MyMilvus:
         Returns:
             _None_: _None_
         """
-        if self.check_collection_exist(collection_name):
-            self.collection = self.client.get_collection(name=collection_name)
-            print(f'{collection_name}设置成功')
+        self.collection = self.collections.get(collection_name)
+        print(f'{collection_name}设置成功')
+
+    def context_cache_stats(self):
+        """_上下文片段缓存的命中/未命中/淘汰计数_
+        Returns:
+            _dict_: _缓存统计,未开启缓存时返回None_
+        """
+        if self.context_cache is None:
+            return None
+        return self.context_cache.stats()
+
+    def query_batch_stats(self):
+        """_问题向量化微批的批大小与排队等待时间直方图_
+        Returns:
+            _dict_: _直方图统计,未开启微批时返回None_
+        """
+        if self.query_batcher is None:
+            return None
+        return self.query_batcher.stats()
+
+    def metrics_stats(self):
+        """_进程内埋点指标(各操作各阶段耗时分位数、计数、错误数)_
+        Returns:
+            _dict_: _InMemoryMetrics的快照,未开启埋点或未使用InMemoryMetrics时返回None_
+        """
+        for sink in self.metrics.sinks:
+            if isinstance(sink, InMemoryMetrics):
+                return sink.snapshot()
+        return None
+
+    def _encode_query(self, query):
+        """_问题向量化,开启微批时与其他并发问题合并encode_
+        Returns:
+            _np.ndarray_: _形状为(1, dim)的归一化向量_
+        """
+        with self.metrics.stage("encode"):
+            if self.query_batcher is None:
+                return self.embeddings.encode([query],
+                                              normalize_embeddings=True)
+            return np.asarray([self.query_batcher.encode(query)])
+
+    def result_cache_stats(self):
+        """_查询结果缓存的命中/未命中计数_
+        Returns:
+            _dict_: _缓存统计,未开启缓存时返回None_
+        """
+        if self.result_cache is None:
+            return None
+        return self.result_cache.stats()
+
+    def _bump_collection_version(self, collection_name):
+        with self._versions_lock:
+            self._collection_versions[collection_name] = (
+                self._collection_versions.get(collection_name, 0) + 1)
+
+    def _lookup_result_cache(self, kind, collection_name, query, *params):
+        """_查询结果缓存_
+        Args:
+            kind (_str_): _查询方法,不同方法返回结构不同_
+            collection_name (_str_): _集合(空间名称)_
+            query (_str_): _问题文本,去除多余空白后作为键_
+            params: _影响结果的其他参数_
+        Returns:
+            _tuple_: _(缓存键, 当前版本号, 缓存结果),未开启缓存时缓存键为None_
+        """
+        if self.result_cache is None:
+            return None, None, None
+        key = (kind, collection_name, " ".join(query.split()),
+               json.dumps(params, sort_keys=True, ensure_ascii=False,
+                          default=str))
+        # 先取版本号再查询,查询期间数据变化时写入的结果会立即失效
+        version = self._collection_versions.get(collection_name, 0)
+        return key, version, self.result_cache.get(key, version)
+
+    def _on_documents_changed(self, collection_name, files):
+        """_集合中某些文件的数据发生变化后,使相关缓存失效_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            files (_iterable_): _发生变化的文件名_
+        """
+        with self.metrics.stage("invalidate"):
+            self._bump_collection_version(collection_name)
+            if self.context_cache is not None:
+                for file in files:
+                    self.context_cache.invalidate(collection_name, file)
+            self._refresh_lexical_index(collection_name, files)
+            self._prune_full_vectors(collection_name, files)
+
+    def _on_collection_dropped(self, collection_name):
+        """_集合被删除后,清理该集合的所有缓存_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+        """
+        self._bump_collection_version(collection_name)
+        if self.context_cache is not None:
+            self.context_cache.invalidate_collection(collection_name)
+        with self._lexical_lock:
+            self._lexical_indexes.pop(collection_name, None)
+            # 正在构建的索引完成后丢弃
+            self._lexical_building.pop(collection_name, None)
+            self._lexical_dirty.discard(collection_name)
+            index_path = self._lexical_index_path(collection_name)
+            for path in (index_path, index_path + '.dirty'):
+                if os.path.exists(path):
+                    os.remove(path)
+        self._vector_transforms.pop(collection_name, None)
+        transform_path = self._vector_transform_path(collection_name)
+        if os.path.exists(transform_path):
+            os.remove(transform_path)
+        self._drop_full_vectors(collection_name)
+
+    def _vector_transform_path(self, collection_name):
+        return os.path.join(self.db_file_path, 'vector_transforms',
+                            f'{collection_name}.npz')
+
+    def _full_vector_store_path(self):
+        return os.path.join(self.db_file_path, 'full_vectors.sqlite3')
+
+    def _drop_full_vectors(self, collection_name):
+        """_删除旁路存储中集合的全部原始向量(重启后旁路存储尚未打开时也会删除)_"""
+        if self._full_vectors is None and not os.path.exists(
+                self._full_vector_store_path()):
             return
-        else:
-            raise Exception(f'{collection_name} has not exsit')
+        self._get_full_vector_store().drop_collection(collection_name)
+
+    def _get_full_vector_store(self):
+        if self._full_vectors is None:
+            with self._full_vectors_lock:
+                if self._full_vectors is None:
+                    self._full_vectors = _FullVectorStore(
+                        self._full_vector_store_path())
+        return self._full_vectors
+
+    def _get_vector_transform(self, collection_name, collection=None):
+        """_读取集合metadata中记录的降维方式_
+        Returns:
+            _VectorTransform_: _降维方式,集合未降维时返回None_
+        """
+        transform = self._vector_transforms.get(collection_name)
+        if transform is not None:
+            return transform or None
+        if collection is None:
+            collection = self._get_collection(collection_name)
+        metadata = collection.metadata or {}
+        transform = False
+        if metadata.get("vector:transform"):
+            transform = _VectorTransform(metadata["vector:transform"],
+                                         metadata["vector:dim"],
+                                         metadata.get("vector:keep_full", 0))
+            transform_path = self._vector_transform_path(collection_name)
+            if os.path.exists(transform_path):
+                transform.load(transform_path)
+        self._vector_transforms[collection_name] = transform
+        return transform or None
+
+    def _ensure_vector_transform(self, collection_name, collection,
+                                 sentence_list, import_stats=None):
+        """_降维集合首次入库时拟合变换并保存_
+        pca用前pca_fit_samples条片段拟合,truncate只需1条片段确定原始维度
+        Returns:
+            _np.ndarray_: _拟合用的前若干条片段的原始向量,写入时复用;未拟合时返回None_
+        """
+        transform = self._get_vector_transform(collection_name, collection)
+        if transform is None or transform.fitted or not sentence_list:
+            return None
+        with self._transform_locks_lock:
+            lock = self._transform_locks.setdefault(collection_name,
+                                                    threading.Lock())
+        with lock:
+            # 并发的首次导入只拟合一次
+            if transform.fitted:
+                return None
+            with self.metrics.stage("vector_transform"):
+                with self.metrics.stage("encode"):
+                    sample = self._encode_documents(
+                        sentence_list[:self._fit_sample_size(transform)],
+                        import_stats)
+                transform.fit(sample)
+                transform.save(self._vector_transform_path(collection_name))
+            return sample
+
+    def _fit_sample_size(self, transform):
+        return self.pca_fit_samples if transform.kind == "pca" else 1
+
+    def _embed_for_collection(self,
+                              collection_name,
+                              ids_list,
+                              sentence_list,
+                              metadatas_list,
+                              import_stats=None,
+                              prefetched=None,
+                              offset=0):
+        """_生成写入集合的向量,降维集合会应用变换并按需保存原始向量_
+        prefetched为拟合变换时已向量化的前若干条片段,offset为本批在全部片段中的起始位置,
+        落在prefetched范围内的片段不再重复向量化
+        """
+        if prefetched is not None:
+            prefetched = prefetched[offset:offset + len(sentence_list)]
+        reuse_num = 0 if prefetched is None else len(prefetched)
+        with self.metrics.stage("encode"):
+            if not reuse_num:
+                vectors = self._encode_documents(sentence_list, import_stats)
+            elif reuse_num == len(sentence_list):
+                vectors = np.asarray(prefetched[:reuse_num])
+            else:
+                vectors = np.vstack([
+                    prefetched[:reuse_num],
+                    self._encode_documents(sentence_list[reuse_num:],
+                                           import_stats)
+                ])
+        transform = self._get_vector_transform(collection_name)
+        if transform is None:
+            return vectors
+        if transform.keep_full:
+            self._get_full_vector_store().put_many(
+                collection_name, ids_list,
+                [metadata['file'] for metadata in metadatas_list], vectors)
+        return transform.apply(vectors)
+
+    def _prune_full_vectors(self, collection_name, files):
+        """_文件数据变化后,删除旁路存储中已不在chroma中的原始向量_"""
+        files = list(files)
+        if not files or (self._full_vectors is None and not os.path.exists(
+                self._full_vector_store_path())):
+            return
+        try:
+            transform = self._get_vector_transform(collection_name)
+            if transform is None or not transform.keep_full:
+                return
+            collection = self._get_collection(collection_name)
+            keep_ids = set()
+            for start in range(0, len(files), self.file_filter_chunk_size):
+                file_chunk = files[start:start + self.file_filter_chunk_size]
+                keep_ids.update(
+                    collection.get(where=self._file_filter(file_chunk),
+                                   include=[])['ids'])
+            self._get_full_vector_store().prune_files(collection_name, files,
+                                                      keep_ids)
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+
+    def _full_distances(self, collection_name, query_embeddings, result):
+        """_用原始精度向量重新计算候选的距离,没有原始向量的候选保留原距离_"""
+        ids = result['ids'][0]
+        full = self._get_full_vector_store().get_many(collection_name, ids)
+        query_vector = np.asarray(query_embeddings[0], dtype=np.float32)
+        distances = list(result['distances'][0])
+        for position, id_item in enumerate(ids):
+            vector = full.get(id_item)
+            if vector is not None:
+                distances[position] = 1 - float(
+                    np.dot(query_vector, vector.astype(np.float32)))
+        return distances
+
+    def _rescore_full(self, collection_name, query_embeddings, result):
+        """_用原始精度向量重新计算候选的距离并排序_"""
+        distances = self._full_distances(collection_name, query_embeddings,
+                                         result)
+        order = np.argsort(np.asarray(distances), kind="stable").tolist()
+        rescored = dict(result)
+        rescored['distances'] = [distances]
+        return self._take_result(rescored, order)
+
+    @instrumented
+    def vector_storage_report(self, collection_name):
+        """_降维集合的内存节省情况_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+        Returns:
+            _dict_: _向量数量、原始/存储维度、索引向量字节数及节省比例,未降维时返回None_
+        """
+        try:
+            collection = self._get_collection(collection_name)
+            transform = self._get_vector_transform(collection_name,
+                                                   collection)
+            if transform is None or not transform.fitted:
+                return None
+            count = collection.count()
+            full_bytes = count * transform.full_dim * 4
+            stored_bytes = count * transform.dim * 4
+            return {
+                "count": count,
+                "transform": transform.kind,
+                "full_dim": transform.full_dim,
+                "stored_dim": transform.dim,
+                "full_index_bytes": full_bytes,
+                "stored_index_bytes": stored_bytes,
+                "saved_bytes": full_bytes - stored_bytes,
+                "saved_ratio": 1 - transform.dim / transform.full_dim,
+                # 旁路保存的原始向量在磁盘(sqlite)中,不占用HNSW内存
+                "full_vectors_disk_bytes": (count * transform.full_dim * 2
+                                            if transform.keep_full else 0)
+            }
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+
+    @instrumented
+    def evaluate_vector_recall(self, collection_name, queries, k=10):
+        """_用原始向量暴力检索作为基准,评估降维索引的recall@k_
+        需要集合保留原始向量(keep_full_vectors=True)
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            queries (_list_): _评估用的问题文本_
+            k (int, optional): _取前k条_. Defaults to 10.
+        Returns:
+            _dict_: _{"reduced": 仅降维索引的recall, "rescored": 原始向量重打分后的recall}_
+        """
+        try:
+            collection = self._get_collection(collection_name)
+            transform = self._get_vector_transform(collection_name,
+                                                   collection)
+            if transform is None or not transform.keep_full:
+                raise Exception(f'{collection_name}未保留原始向量,无法评估召回率')
+            full_queries = np.asarray(self.embeddings.encode(
+                list(queries), normalize_embeddings=True),
+                                      dtype=np.float32)
+            # 分批暴力检索得到基准top-k
+            best_scores = np.full((len(full_queries), 0), -np.inf)
+            best_ids = np.empty((len(full_queries), 0), dtype=object)
+            for ids, vectors in self._get_full_vector_store().iter_batches(
+                    collection_name):
+                scores = np.hstack([best_scores, full_queries @ vectors.T])
+                all_ids = np.hstack([
+                    best_ids,
+                    np.tile(np.asarray(ids, dtype=object),
+                            (len(full_queries), 1))
+                ])
+                top = np.argsort(-scores, axis=1)[:, :k]
+                best_scores = np.take_along_axis(scores, top, axis=1)
+                best_ids = np.take_along_axis(all_ids, top, axis=1)
+            reduced = collection.query(
+                query_embeddings=transform.apply(full_queries),
+                n_results=k * max(int(self.rescore_overfetch), 1),
+                include=["distances"])
+            recall = {"reduced": 0.0, "rescored": 0.0}
+            for query_index in range(len(full_queries)):
+                truth = set(best_ids[query_index].tolist())
+                if not truth:
+                    continue
+                candidates = {
+                    "ids": [reduced['ids'][query_index]],
+                    "distances": [reduced['distances'][query_index]]
+                }
+                recall["reduced"] += len(
+                    truth & set(candidates['ids'][0][:k])) / len(truth)
+                rescored = self._rescore_full(collection_name,
+                                              full_queries[query_index:
+                                                           query_index + 1],
+                                              candidates)
+                recall["rescored"] += len(
+                    truth & set(rescored['ids'][0][:k])) / len(truth)
+            for key in recall:
+                recall[key] /= max(len(full_queries), 1)
+            return recall
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+
+    def _lexical_index_path(self, collection_name):
+        return os.path.join(self.db_file_path, 'bm25',
+                            f'{collection_name}.pkl')
+
+    def _get_lexical_index(self, collection_name):
+        """_获取集合的BM25索引,未就绪时在后台线程中加载/构建_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+        Returns:
+            _BM25Index_: _BM25索引,就绪前返回None(调用方只使用向量检索)_
+        """
+        index = self._lexical_indexes.get(collection_name)
+        if index is not None:
+            return index
+        self._start_lexical_build(collection_name)
+        return self._lexical_indexes.get(collection_name)
+
+    @instrumented
+    def load_lexical_index(self, collection_name, timeout=None):
+        """_加载集合的BM25索引并等待完成(如服务启动时预热)_
+        混合检索首次用到索引时会在后台加载,加载完成前只使用向量检索
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            timeout (_float_, optional): _最长等待秒数_. Defaults to None,一直等待.
+        Returns:
+            _boolean_: _索引是否已就绪_
+        """
+        done = self._start_lexical_build(collection_name)
+        if done is not None:
+            done.wait(timeout)
+        return collection_name in self._lexical_indexes
+
+    def _start_lexical_build(self, collection_name, pending=()):
+        """_启动后台线程加载/构建BM25索引,正在构建时不重复启动_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            pending (_iterable_): _需要在构建完成前重新读取的文件_
+        Returns:
+            _threading.Event_: _构建结束时置位,索引已就绪时返回None_
+        """
+        with self._lexical_lock:
+            if collection_name in self._lexical_indexes:
+                return None
+            build = self._lexical_building.get(collection_name)
+            if build is not None:
+                build["pending"].update(pending)
+                return build["done"]
+            build = {"pending": set(pending), "done": threading.Event()}
+            self._lexical_building[collection_name] = build
+        print(f'{collection_name} BM25索引后台加载中,完成前混合检索只使用向量检索')
+        if tokenizer_name() != "jieba":
+            print('未安装jieba,中文按单字+双字切分,建议pip install jieba')
+        threading.Thread(target=self._build_lexical_index,
+                         args=(collection_name, build),
+                         daemon=True).start()
+        return build["done"]
+
+    def _build_lexical_index(self, collection_name, build):
+        """_后台线程:从磁盘加载BM25索引,没有或与集合数据量不一致时从chroma重建_
+        不持有_lexical_lock,构建期间变化的文件记录在build["pending"]中,发布前重新读取
+        """
+        try:
+            with self.metrics.operation("build_lexical_index"):
+                collection = self._get_collection(collection_name)
+                index_path = self._lexical_index_path(collection_name)
+                index = None
+                if os.path.exists(index_path) and not os.path.exists(
+                        index_path + '.dirty'):
+                    index = BM25Index.load(index_path)
+                changed = index is None or len(index) != collection.count()
+                if changed:
+                    index = BM25Index()
+                    page_size = 10000
+                    offset = 0
+                    while True:
+                        r = collection.get(
+                            include=["documents", "metadatas"],
+                            limit=page_size,
+                            offset=offset)
+                        if not r['ids']:
+                            break
+                        index.add(r['ids'], r['documents'], r['metadatas'])
+                        offset += len(r['ids'])
+                while True:
+                    with self._lexical_lock:
+                        if self._lexical_building.get(
+                                collection_name) is not build:
+                            # 构建期间集合被删除
+                            return
+                        files = build["pending"]
+                        if not files:
+                            del self._lexical_building[collection_name]
+                            self._lexical_indexes[collection_name] = index
+                            break
+                        build["pending"] = set()
+                    self._apply_lexical_changes(index, collection, files)
+                    changed = True
+                if changed:
+                    self._schedule_lexical_save(collection_name)
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+            with self._lexical_lock:
+                if self._lexical_building.get(collection_name) is build:
+                    del self._lexical_building[collection_name]
+        finally:
+            build["done"].set()
+
+    def _refresh_lexical_index(self, collection_name, files):
+        """_文件数据变化后更新BM25索引_
+        已加载的索引从chroma重新读取这些文件;正在构建的索引在完成前补读;
+        尚未加载时,开启了hybrid_search则后台加载磁盘上的索引,否则标记其已过期(下次加载时重建)
+        """
+        files = list(files)
+        if not files:
+            return
+        try:
+            with self._lexical_lock:
+                index = self._lexical_indexes.get(collection_name)
+                build = self._lexical_building.get(collection_name)
+                if index is None:
+                    if build is not None:
+                        build["pending"].update(files)
+                        return
+                    index_path = self._lexical_index_path(collection_name)
+                    if not os.path.exists(index_path):
+                        return
+                    if not self.hybrid_search:
+                        open(index_path + '.dirty', 'w').close()
+                        return
+            if index is None:
+                if self._start_lexical_build(collection_name,
+                                             files) is not None:
+                    return
+                # 启动前已由其他线程加载完成
+                index = self._lexical_indexes.get(collection_name)
+                if index is None:
+                    return
+            self._apply_lexical_changes(index,
+                                        self._get_collection(collection_name),
+                                        files)
+            self._schedule_lexical_save(collection_name)
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+
+    def _apply_lexical_changes(self, index, collection, files):
+        """_从chroma重新读取若干文件的片段,替换BM25索引中这些文件的文档_"""
+        files = list(files)
+        index.remove_files(files)
+        for start in range(0, len(files), self.file_filter_chunk_size):
+            file_chunk = files[start:start + self.file_filter_chunk_size]
+            r = collection.get(where=self._file_filter(file_chunk),
+                               include=["documents", "metadatas"])
+            index.add(r['ids'], r['documents'], r['metadatas'])
+
+    def _schedule_lexical_save(self, collection_name):
+        """_标记BM25索引已变化,延迟保存_"""
+        if self.lexical_save_interval <= 0:
+            self._lexical_indexes[collection_name].save(
+                self._lexical_index_path(collection_name))
+            return
+        with self._lexical_lock:
+            if collection_name not in self._lexical_dirty:
+                self._lexical_dirty.add(collection_name)
+                dirty_path = self._lexical_index_path(
+                    collection_name) + '.dirty'
+                os.makedirs(os.path.dirname(dirty_path), exist_ok=True)
+                open(dirty_path, 'w').close()
+            if self._lexical_save_timer is None:
+                self._lexical_save_timer = threading.Timer(
+                    self.lexical_save_interval, self.flush_lexical_indexes)
+                self._lexical_save_timer.daemon = True
+                self._lexical_save_timer.start()
+
+    def flush_lexical_indexes(self):
+        """_立即保存所有未落盘的BM25索引(如进程退出前调用)_"""
+        with self._lexical_lock:
+            dirty = self._lexical_dirty
+            self._lexical_dirty = set()
+            if self._lexical_save_timer is not None:
+                self._lexical_save_timer.cancel()
+                self._lexical_save_timer = None
+        for collection_name in dirty:
+            index = self._lexical_indexes.get(collection_name)
+            if index is None:
+                continue
+            index_path = self._lexical_index_path(collection_name)
+            try:
+                index.save(index_path)
+            except Exception as e:
+                print(traceback.format_exc())
+                self.metrics.error(e)
+                with self._lexical_lock:
+                    self._lexical_dirty.add(collection_name)
+                continue
+            with self._lexical_lock:
+                # 保存期间又有变化时保留标记,等待下一次保存
+                if collection_name not in self._lexical_dirty:
+                    self._remove_dirty_marker(index_path)
+
+    @staticmethod
+    def _remove_dirty_marker(index_path):
+        if os.path.exists(index_path + '.dirty'):
+            os.remove(index_path + '.dirty')
+
+    def _hybrid_fuse(self, collection, collection_name, query,
+                     query_embeddings, result, limit_num, filter_expr):
+        """_把向量检索结果与BM25检索结果做RRF(倒数排名)融合_
+        Args:
+            collection (_Collection_): _集合句柄_
+            collection_name (_str_): _集合(空间名称)_
+            query (_str_): _问题文本_
+            query_embeddings (_np.ndarray_): _问题向量_
+            result (_QueryResult_): _向量检索结果(候选数多于limit_num)_
+            limit_num (_int_): _返回条数_
+            filter_expr (_dict_): _过滤条件,对BM25结果同样生效_
+        Returns:
+            _tuple_: _(与collection.query相同结构的融合结果, 不受相似度阈值限制的id集合)_
+            只有向量候选中没有、且归一化BM25得分不低于bm25_min_score的片段不受阈值限制
+        """
+        vector_ids = result['ids'][0]
+        candidate_num = len(vector_ids)
+        index = self._get_lexical_index(collection_name)
+        if index is None:
+            # BM25索引加载完成前只使用向量检索结果
+            self.metrics.count("lexical_index_not_ready")
+            return self._take_result(
+                result, range(min(candidate_num, limit_num))), set()
+        lexical_hits = index.search(query, max(candidate_num, limit_num))
+        lexical_ids = [hit[0] for hit in lexical_hits]
+        min_score = self.bm25_min_score * index.max_score(query)
+        vector_id_set = set(vector_ids)
+        keep_ids = {
+            id_item
+            for id_item, _, score in lexical_hits
+            if id_item not in vector_id_set and score >= min_score
+        }
+        if lexical_ids and filter_expr:
+            allowed = set(
+                collection.get(ids=lexical_ids,
+                               where=filter_expr,
+                               include=[])['ids'])
+            lexical_ids = [
+                id_item for id_item in lexical_ids if id_item in allowed
+            ]
+        fused = {}
+        for ranked_ids in (vector_ids, lexical_ids):
+            for rank, id_item in enumerate(ranked_ids):
+                fused[id_item] = fused.get(id_item,
+                                           0) + 1 / (self.rrf_k + rank + 1)
+        top_ids = sorted(fused, key=fused.get, reverse=True)[:limit_num]
+        rows = {
+            id_item: (document, metadata, distance)
+            for id_item, document, metadata, distance in zip(
+                vector_ids, result['documents'][0], result['metadatas'][0],
+                result['distances'][0])
+        }
+        # 只被BM25召回的片段,取回文本并计算与问题的向量距离
+        missing = [id_item for id_item in top_ids if id_item not in rows]
+        if missing:
+            r = collection.get(ids=missing,
+                               include=["documents", "metadatas", "embeddings"])
+            query_vector = np.asarray(query_embeddings[0], dtype=np.float32)
+            for id_item, document, metadata, embedding in zip(
+                    r['ids'], r['documents'], r['metadatas'],
+                    r['embeddings']):
+                distance = 1 - float(
+                    np.dot(query_vector, np.asarray(embedding,
+                                                    dtype=np.float32)))
+                rows[id_item] = (document, metadata, distance)
+        top_ids = [id_item for id_item in top_ids if id_item in rows]
+        keep_ids.intersection_update(top_ids)
+        fused_result = {
+            "ids": [top_ids],
+            "documents": [[rows[id_item][0] for id_item in top_ids]],
+            "metadatas": [[rows[id_item][1] for id_item in top_ids]],
+            "distances": [[rows[id_item][2] for id_item in top_ids]]
+        }
+        return fused_result, keep_ids
 
     def create_index(self, collection_name):
         """_创建索引_
@@ -69,14 +1655,20 @@ class MyMilvus:
         pass
 
     def load_collection(self, collection_name):
-        """_加载集合_
+        """_加载集合,设置为当前集合(self.collection)_
 
         Args:
             collection_name (_str_): _集合(空间名称)_
         Returns:
-            _None_: _None_
+            _Collection_: _集合句柄_
         """
         self.set_collection(collection_name)
+        return self.collection
+
+    def _get_collection(self, collection_name):
+        """_内部使用的集合句柄获取,不修改self.collection,并发调用安全_"""
+        with self.metrics.stage("resolve"):
+            return self.collections.get(collection_name)
 
     def check_collection_exist(self, collection_name):
         """_检查集合是否存在_
@@ -94,6 +1686,7 @@ class MyMilvus:
             print(f"Error checking collection existence: {e}")
             return False
 
+    @instrumented
     def delete_milvus_table(self, collection_name):
         """_删除集合(空间)_
         Args:
@@ -103,33 +1696,71 @@ class MyMilvus:
         """
         try:
             if self.check_collection_exist(collection_name):
-                self.client.delete_collection(collection_name)
+                for client in self.clients:
+                    client.delete_collection(collection_name)
+                self.collections.drop(collection_name)
+                self._on_collection_dropped(collection_name)
                 print(f'{collection_name} has delete')
                 return collection_name
             else:
                 raise Exception(f'{collection_name}！！ has not exsit')
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
             return 0
 
-    def query_by_file_list(self, collection_name, file_name_list):
+    @instrumented
+    def query_by_file_list(self,
+                           collection_name,
+                           file_name_list,
+                           group_by_file=False):
         """_根据文件名拿出该空间内该文件列表中每个文件名的所有片段的向量id_
         Args:
             collection_name (_str_): _集合(空间名称)_
             file_name_list (_type_): __文件列表__
+            group_by_file (_bool_, optional): _是否按文件分组返回_. Defaults to False.
         Returns:
-            _list_: _查找到的向量id的列表_
+            _list_: _查找到的向量id的列表,group_by_file为True时返回{文件名: id列表}_
         """
         try:
+            collection = self._get_collection(collection_name)
+            if group_by_file:
+                return self._get_ids_by_files(collection, file_name_list)
             result = []
-            for file_name in file_name_list:
-                result_item = self.query_by_file(collection_name, file_name)
-                # 合并列表数据
-                result += result_item
+            for start in range(0, len(file_name_list),
+                               self.file_filter_chunk_size):
+                # 只需要id,不取文本与元信息
+                file_chunk = file_name_list[start:start +
+                                            self.file_filter_chunk_size]
+                result += collection.get(where=self._file_filter(file_chunk),
+                                         include=[])['ids']
             return result
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
+
+    def _get_ids_by_files(self, collection, file_name_list):
+        """_按文件名列表分块查询片段id,并按文件分组_
+        Args:
+            collection (_Collection_): _集合句柄_
+            file_name_list (_list_): _文件列表_
+        Returns:
+            _dict_: _{文件名: id列表}_
+        """
+        file_name_list = list(file_name_list)
+        grouped = {file_name: [] for file_name in file_name_list}
+        for start in range(0, len(file_name_list),
+                           self.file_filter_chunk_size):
+            file_chunk = file_name_list[start:start +
+                                        self.file_filter_chunk_size]
+            # 分组需要file字段,所以只取metadatas
+            r = collection.get(where=self._file_filter(file_chunk),
+                               include=["metadatas"])
+            for id_item, metadata_item in zip(r['ids'], r['metadatas']):
+                grouped[metadata_item['file']].append(id_item)
+        return grouped
 
+    @instrumented
     def query_by_file(self, collection_name, file_name):
         """_给一个文件名,返回向量数据库中该文件名的所有片段向量id_
         class GetResult(TypedDict):
@@ -148,13 +1779,15 @@ class MyMilvus:
         List[dict(GetResult())]
         """
         try:
-            self.load_collection(collection_name)
-            return self.collection.get(where={"file": {
+            collection = self._get_collection(collection_name)
+            return collection.get(where={"file": {
                 "$eq": file_name
-            }})['ids']
+            }}, include=[])['ids']
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
 
+    @instrumented
     def delete_document_milvus(self, collection_name, file_name):
         """_删除某个空间内某个文件名的所有向量_
         Args:
@@ -164,26 +1797,72 @@ class MyMilvus:
             _boolean_: _是否删除成功_
         """
         try:
-            self.load_collection(collection_name)
-            self.collection.delete(where={"file": {"$eq": file_name}})
+            collection = self._get_collection(collection_name)
+            with self.metrics.stage("write"):
+                collection.delete(where={"file": {"$eq": file_name}})
+            self._on_documents_changed(collection_name, [file_name])
         # 表示删除空间中metadatas中file为 file_name的文档项
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
 
-    def add_document(self, docs: List[message_format.DocumentFormat],
-                     collection_name, file_post_url, send_msg):
+    @instrumented
+    def delete_documents(self, collection_name, file_names):
+        """_批量删除某个空间内多个文件名的所有向量_
+        Args:
+            collection_name (_str_): _空间名(集合名)_
+            file_names (_list_): _文件名列表_
+        Returns:
+            _dict_: _{文件名: 被删除的id列表}_
+        """
+        file_names = list(file_names)
+        try:
+            collection = self._get_collection(collection_name)
+            deleted = {}
+            for start in range(0, len(file_names),
+                               self.file_filter_chunk_size):
+                grouped = self._get_ids_by_files(
+                    collection,
+                    file_names[start:start + self.file_filter_chunk_size])
+                ids = [id_item for ids in grouped.values() for id_item in ids]
+                if ids:
+                    with self.metrics.stage("write"):
+                        collection.delete(ids=ids)
+                    self.metrics.count("chunks", len(ids))
+                deleted.update(grouped)
+            return deleted
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+        finally:
+            self._on_documents_changed(collection_name, file_names)
+
+    @instrumented
+    def add_document(self,
+                     docs: List[message_format.DocumentFormat],
+                     collection_name,
+                     file_post_url,
+                     send_msg,
+                     pipelined=None):
         """_添加文章片段到集合(空间)中_
         Args:
             docs (_List[DocumentFormat]_): _文章分割后的片段列表_
             collection_name (_str_): _集合(空间名称)_
             file_post_url(_str_):_回调函数请求的服务地址_
             send_msg(dict):_要发送的消息_
+            pipelined (_bool_, optional): _是否使用流水线入库_. Defaults to None,取self.pipelined_ingest.
         Returns:
             _None_: _None_
         """
+        changed_files = set()
+        import_stats = {"hits": 0, "misses": 0}
         try:
-            self.load_collection(collection_name)
-            if self.collection:
+            collection = self._get_collection(collection_name)
+            if collection:
+                changed_files = {
+                    str(item.metadata['source'])
+                    for item in docs
+                }
                 ids_list = []
                 sentence_list = []
                 metadatas_list = []
@@ -191,26 +1870,31 @@ class MyMilvus:
                     embedding_docs_item: dict = {
                         "id": str(uuid.uuid4()),
                         "sentence": item.sentence,
-                        "metadatas": {
-                            "complete_content": item.complete_content,
-                            "is_title": int(item.is_title),
-                            "is_head": int(item.is_head),
-                            "level": int(item.level),
-                            "outline": str(item.outline),
-                            "file": str(item.metadata['source']),
-                            "index": int(item.metadata['chunk_num'])
-                        }
+                        "metadatas": self._build_metadata(item)
                     }
                     ids_list.append(embedding_docs_item['id'])
                     sentence_list.append(embedding_docs_item['sentence'])
                     metadatas_list.append(embedding_docs_item['metadatas'])
                 num_sentences = len(sentence_list)
+                self.metrics.count("chunks", num_sentences)
                 num_batches = (num_sentences + mcfg.MILVUS_INSERT_BATCH -
                                1) // mcfg.MILVUS_INSERT_BATCH
                 print(f"num_bathes: {num_batches}")
                 # 每个batch的进度值
                 single_progress = math.floor(1 /
                                              (num_batches) * 100000) / 100000
+                fit_vectors = self._ensure_vector_transform(
+                    collection_name, collection, sentence_list, import_stats)
+                if pipelined is None:
+                    pipelined = self.pipelined_ingest
+                if pipelined:
+                    self._add_batches_pipelined(collection, collection_name,
+                                                ids_list,
+                                                sentence_list, metadatas_list,
+                                                single_progress,
+                                                file_post_url, send_msg,
+                                                import_stats, fit_vectors)
+                    return
                 for i in range(num_batches):
                     start_index = i * mcfg.MILVUS_INSERT_BATCH
                     end_index = min((i + 1) * mcfg.MILVUS_INSERT_BATCH,
@@ -220,26 +1904,559 @@ class MyMilvus:
                     # 在引起崩溃的代码片段前加上该语句，打印出引起崩溃的错误
                     # 考虑减小向量维度 减小批量入库的文档数量
 
-                    self.collection.add(
+                    embeddings = self._embed_for_collection(
+                        collection_name, ids_list[start_index:end_index],
+                        sentence_list[start_index:end_index],
+                        metadatas_list[start_index:end_index], import_stats,
+                        fit_vectors, start_index)
+                    with self.metrics.stage("write"):
+                        collection.add(
+                            documents=sentence_list[start_index:end_index],
+                            embeddings=embeddings,
+                            metadatas=metadatas_list[start_index:end_index],
+                            ids=ids_list[start_index:end_index])
+                    self._advance_progress(i, num_batches, single_progress,
+                                           send_msg)
+                    self._send_callback(file_post_url, send_msg)
+            else:
+                raise Exception(f'请先加载{collection_name}空间')
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+        finally:
+            # 无论是否全部写入成功,都让这些文件的缓存失效
+            self._on_documents_changed(collection_name, changed_files)
+            self._report_import_stats(import_stats)
+
+    @instrumented
+    def add_document_stream(self,
+                            collection_name,
+                            chunk_iter,
+                            file_post_url=None,
+                            send_msg=None,
+                            expected_total=None):
+        """_以流的方式添加文章片段,按MILVUS_INSERT_BATCH逐批读取迭代器并写入,内存占用与文件大小无关_
+        PCA降维集合首次入库时会先缓存pca_fit_samples条片段用于拟合
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            chunk_iter (_Iterable[DocumentFormat]_): _文章片段迭代器(如分割器的生成器)_
+            file_post_url(_str_, optional):_回调函数请求的服务地址_
+            send_msg(dict, optional):_要发送的消息,processed为已处理片段数_. Defaults to None,使用{"progress": 0}.
+            expected_total (_int_, optional): _预计片段总数,提供时按比例更新progress_
+        Returns:
+            _int_: _已写入的片段数_
+        """
+        changed_files = set()
+        import_stats = {"hits": 0, "misses": 0}
+        processed = 0
+        if send_msg is None:
+            send_msg = {"progress": 0}
+        try:
+            collection = self._get_collection(collection_name)
+            chunk_iter = iter(chunk_iter)
+            # 未拟合的降维集合先读取拟合所需的片段(pca为pca_fit_samples条),拟合后再逐批写入
+            fit_vectors = None
+            transform = self._get_vector_transform(collection_name, collection)
+            if transform is not None and not transform.fitted:
+                head = list(
+                    itertools.islice(chunk_iter,
+                                     self._fit_sample_size(transform)))
+                fit_vectors = self._ensure_vector_transform(
+                    collection_name, collection,
+                    [item.sentence for item in head], import_stats)
+                chunk_iter = itertools.chain(head, chunk_iter)
+            while True:
+                window = list(
+                    itertools.islice(chunk_iter, mcfg.MILVUS_INSERT_BATCH))
+                if not window:
+                    break
+                ids_list = [str(uuid.uuid4()) for _ in window]
+                sentence_list = [item.sentence for item in window]
+                metadatas_list = [self._build_metadata(item) for item in window]
+                changed_files.update(metadata['file']
+                                     for metadata in metadatas_list)
+                embeddings = self._embed_for_collection(
+                    collection_name, ids_list, sentence_list, metadatas_list,
+                    import_stats, fit_vectors, processed)
+                with self.metrics.stage("write"):
+                    collection.add(documents=sentence_list,
+                                   embeddings=embeddings,
+                                   metadatas=metadatas_list,
+                                   ids=ids_list)
+                processed += len(window)
+                self.metrics.count("chunks", len(window))
+                if file_post_url:
+                    send_msg["processed"] = processed
+                    if expected_total:
+                        # 结束前进度不到1
+                        send_msg["progress"] = min(
+                            math.floor(processed / expected_total * 100000) /
+                            100000, 0.99999)
+                    self._send_callback(file_post_url, send_msg)
+            if file_post_url:
+                send_msg["processed"] = processed
+                send_msg["progress"] = 1
+                send_msg["message"] = "导入成功"
+                self._send_callback(file_post_url, send_msg)
+            return processed
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+        finally:
+            self._on_documents_changed(collection_name, changed_files)
+            self._report_import_stats(import_stats)
+
+    def _encode_documents(self, sentence_list, import_stats=None):
+        """_入库文本向量化,开启向量缓存时只对未缓存的文本调用模型_
+        Args:
+            sentence_list (_list_): _文本列表_
+            import_stats (_dict_, optional): _累计缓存命中/未命中数量_
+        Returns:
+            _np.ndarray_: _归一化后的向量_
+        """
+        if self.embedding_cache is None:
+            if import_stats is not None:
+                import_stats["misses"] += len(sentence_list)
+            return self.embeddings.encode(sentence_list,
+                                          normalize_embeddings=True)
+        keys = [self.embedding_cache.make_key(text) for text in sentence_list]
+        cached = self.embedding_cache.get_many(set(keys))
+        # 同一批中重复的文本只向量化一次
+        missing = {}
+        for key, text in zip(keys, sentence_list):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.encode(list(missing.values()),
+                                             normalize_embeddings=True)
+            new_items = list(zip(missing.keys(), vectors))
+            self.embedding_cache.put_many(new_items)
+            for key, vector in new_items:
+                cached[key] = np.asarray(vector, dtype=np.float32)
+        if import_stats is not None:
+            import_stats["misses"] += len(missing)
+            import_stats["hits"] += len(keys) - len(missing)
+        return np.vstack([cached[key] for key in keys])
+
+    def _report_import_stats(self, import_stats):
+        """_记录并打印本次导入的向量缓存命中率_"""
+        total = import_stats["hits"] + import_stats["misses"]
+        import_stats["hit_rate"] = import_stats["hits"] / total if total else 0
+        self.last_import_stats = import_stats
+        if self.embedding_cache is not None and total:
+            print(f"embedding cache hit rate: {import_stats['hit_rate']:.2%} "
+                  f"({import_stats['hits']}/{total})")
+
+    @staticmethod
+    def _build_metadata(item):
+        """_由文章片段生成入库的metadatas,content_hash用于增量同步时判断片段是否变化_
+        Args:
+            item (_DocumentFormat_): _文章片段_
+        Returns:
+            _dict_: _metadatas_
+        """
+        metadata = {
+            "complete_content": item.complete_content,
+            "is_title": int(item.is_title),
+            "is_head": int(item.is_head),
+            "level": int(item.level),
+            "outline": str(item.outline),
+            "file": str(item.metadata['source']),
+            "index": int(item.metadata['chunk_num'])
+        }
+        metadata["content_hash"] = hashlib.sha1(
+            (item.sentence + "\x00" +
+             json.dumps(metadata, sort_keys=True, ensure_ascii=False)
+             ).encode("utf-8")).hexdigest()
+        return metadata
+
+    @staticmethod
+    def _check_num_shards(db_file_path, num_shards):
+        """_校验分片数与库目录中记录的一致,首次打开时写入记录_
+        按文件名路由的get/delete依赖分片数,分片数变化后会访问错误的分片
+        """
+        marker_path = os.path.join(db_file_path, 'sharding.json')
+        if os.path.exists(marker_path):
+            with open(marker_path, encoding='utf-8') as f:
+                stored = int(json.load(f)['num_shards'])
+        else:
+            # 没有记录的已有库按目录结构推断
+            stored = 0
+            if os.path.isdir(db_file_path):
+                stored = sum(
+                    name.startswith('shard_')
+                    for name in os.listdir(db_file_path))
+                if not stored and os.path.exists(
+                        os.path.join(db_file_path, 'chroma.sqlite3')):
+                    stored = 1
+            if not stored:
+                stored = num_shards
+            os.makedirs(db_file_path, exist_ok=True)
+            with open(marker_path, 'w', encoding='utf-8') as f:
+                json.dump({"num_shards": stored}, f)
+        if stored != num_shards:
+            raise Exception(f'{db_file_path}的分片数为{stored},'
+                            f'不能以num_shards={num_shards}打开')
+
+    @staticmethod
+    def _file_filter(files):
+        """_生成按文件名过滤的where条件_"""
+        files = list(files)
+        if len(files) == 1:
+            return {"file": {"$eq": files[0]}}
+        return {"file": {"$in": files}}
+
+    @instrumented
+    def sync_document(self,
+                      collection_name,
+                      docs: List[message_format.DocumentFormat],
+                      file_post_url=None,
+                      send_msg=None):
+        """_增量同步文件片段,只写入新增/变化的片段,删除已不存在的片段_
+        按(file, chunk_num)对齐新旧片段,通过metadatas中的content_hash判断是否变化,
+        未变化的片段不重新向量化也不重写
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            docs (_List[DocumentFormat]_): _文件重新分割后的全部片段_
+            file_post_url(_str_, optional):_回调函数请求的服务地址_
+            send_msg(dict, optional):_要发送的消息_. Defaults to None,使用{"progress": 0}.
+        Returns:
+            _dict_: _{"added","updated","removed","unchanged"}各自的片段数量_
+        """
+        changed_files = set()
+        if send_msg is None:
+            send_msg = {"progress": 0}
+        try:
+            collection = self._get_collection(collection_name)
+            summary = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+            incoming = {}
+            for item in docs:
+                metadata = self._build_metadata(item)
+                incoming[(metadata['file'],
+                          metadata['index'])] = (item.sentence, metadata)
+            if not incoming:
+                return summary
+            changed_files = {key[0] for key in incoming}
+            # 取出这些文件已入库片段的id与content_hash
+            existing = {}
+            remove_ids = []
+            r = collection.get(where=self._file_filter(changed_files),
+                               include=["metadatas"])
+            for id_item, metadata_item in zip(r['ids'], r['metadatas']):
+                key = (metadata_item['file'], int(metadata_item['index']))
+                if key in existing or key not in incoming:
+                    remove_ids.append(id_item)
+                else:
+                    existing[key] = (id_item,
+                                     metadata_item.get('content_hash'))
+            ids_list = []
+            sentence_list = []
+            metadatas_list = []
+            for key, (sentence, metadata) in incoming.items():
+                old = existing.get(key)
+                if old is None:
+                    summary["added"] += 1
+                    ids_list.append(str(uuid.uuid4()))
+                elif old[1] == metadata['content_hash']:
+                    summary["unchanged"] += 1
+                    continue
+                else:
+                    summary["updated"] += 1
+                    ids_list.append(old[0])
+                sentence_list.append(sentence)
+                metadatas_list.append(metadata)
+            batch_size = mcfg.MILVUS_INSERT_BATCH
+            with self.metrics.stage("write"):
+                for start_index in range(0, len(remove_ids), batch_size):
+                    collection.delete(ids=remove_ids[start_index:start_index +
+                                                     batch_size])
+            summary["removed"] = len(remove_ids)
+            self.metrics.count("chunks", len(sentence_list))
+            num_sentences = len(sentence_list)
+            num_batches = (num_sentences + batch_size - 1) // batch_size
+            fit_vectors = self._ensure_vector_transform(
+                collection_name, collection, sentence_list)
+            for i in range(num_batches):
+                start_index = i * batch_size
+                end_index = min((i + 1) * batch_size, num_sentences)
+                embeddings = self._embed_for_collection(
+                    collection_name, ids_list[start_index:end_index],
+                    sentence_list[start_index:end_index],
+                    metadatas_list[start_index:end_index],
+                    prefetched=fit_vectors,
+                    offset=start_index)
+                with self.metrics.stage("write"):
+                    collection.upsert(
                         documents=sentence_list[start_index:end_index],
-                        embeddings=self.embeddings.encode(
-                            sentence_list[start_index:end_index],
-                            normalize_embeddings=True),
+                        embeddings=embeddings,
                         metadatas=metadatas_list[start_index:end_index],
                         ids=ids_list[start_index:end_index])
-                    if i != num_batches - 1:
-                        send_msg["progress"] += single_progress
-                        tools.get_callback_request(file_post_url,
-                                                   send_msg=send_msg)
-                    else:
-                        send_msg["progress"] = 1
-                        send_msg["message"] = "导入成功"
-                        tools.get_callback_request(file_post_url,
-                                                   send_msg=send_msg)
-            else:
-                raise Exception(f'请先加载{collection_name}空间')
+                if file_post_url and i != num_batches - 1:
+                    self._advance_progress(
+                        i, num_batches,
+                        math.floor(1 / num_batches * 100000) / 100000,
+                        send_msg)
+                    self._send_callback(file_post_url, send_msg)
+            if file_post_url:
+                self._advance_progress(0, 1, 1, send_msg)
+                self._send_callback(file_post_url, send_msg)
+            print(f"sync {collection_name}: {summary}")
+            return summary
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
+        finally:
+            self._on_documents_changed(collection_name, changed_files)
+
+    @staticmethod
+    def _advance_progress(batch_index, num_batches, single_progress,
+                          send_msg):
+        """_第batch_index批写入完成后更新进度消息_"""
+        if batch_index != num_batches - 1:
+            send_msg["progress"] += single_progress
+        else:
+            send_msg["progress"] = 1
+            send_msg["message"] = "导入成功"
+
+    def _send_callback(self, file_post_url, send_msg):
+        """_发送进度回调_"""
+        with self.metrics.stage("callback"):
+            tools.get_callback_request(file_post_url, send_msg=send_msg)
+
+    @staticmethod
+    def _put_until_stopped(item_queue, item, stop_event):
+        """_向有界队列放入数据,流水线已停止时放弃,避免阻塞_
+        Returns:
+            _boolean_: _是否放入成功_
+        """
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _add_batches_pipelined(self,
+                               collection,
+                               collection_name,
+                               ids_list,
+                               sentence_list,
+                               metadatas_list,
+                               single_progress,
+                               file_post_url,
+                               send_msg,
+                               import_stats=None,
+                               fit_vectors=None):
+        """_流水线方式分批入库_
+        向量化线程提前编码下一批,当前线程写入chroma,回调线程按顺序发送进度,
+        任一环节出错时停止流水线并在当前线程抛出异常
+        Args:
+            collection (_Collection_): _集合句柄_
+            collection_name (_str_): _集合(空间名称)_
+            ids_list (_list_): _id列表_
+            sentence_list (_list_): _文本列表_
+            metadatas_list (_list_): _metadatas列表_
+            single_progress (_float_): _每个batch的进度值_
+            file_post_url(_str_):_回调函数请求的服务地址_
+            send_msg(dict):_要发送的消息_
+            import_stats (_dict_, optional): _累计向量缓存命中/未命中数量_
+            fit_vectors (_np.ndarray_, optional): _拟合降维变换时已向量化的前若干条片段_
+        Returns:
+            _None_: _None_
+        """
+        batch_size = mcfg.MILVUS_INSERT_BATCH
+        num_sentences = len(sentence_list)
+        num_batches = (num_sentences + batch_size - 1) // batch_size
+        encoded_queue = queue.Queue(maxsize=self.ingest_queue_size)
+        callback_queue = queue.Queue(maxsize=self.ingest_queue_size)
+        stop_event = threading.Event()
+        callback_errors = []
+
+        def encode_worker():
+            for i in range(num_batches):
+                start_index = i * batch_size
+                end_index = min((i + 1) * batch_size, num_sentences)
+                try:
+                    item = (self._embed_for_collection(
+                        collection_name, ids_list[start_index:end_index],
+                        sentence_list[start_index:end_index],
+                        metadatas_list[start_index:end_index], import_stats,
+                        fit_vectors, start_index), None)
+                except Exception as e:
+                    item = (None, e)
+                if not self._put_until_stopped(encoded_queue, item,
+                                               stop_event) or item[1]:
+                    return
+
+        def callback_worker():
+            while True:
+                msg = callback_queue.get()
+                if msg is None:
+                    return
+                # 出错后继续取出剩余消息,但不再发送
+                if callback_errors:
+                    continue
+                try:
+                    self._send_callback(file_post_url, msg)
+                except Exception as e:
+                    callback_errors.append(e)
+                    stop_event.set()
+
+        # 后台线程沿用当前操作的埋点上下文
+        encode_thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(encode_worker, ),
+            daemon=True)
+        callback_thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(callback_worker, ),
+            daemon=True)
+        encode_thread.start()
+        callback_thread.start()
+        try:
+            for i in range(num_batches):
+                start_index = i * batch_size
+                end_index = min((i + 1) * batch_size, num_sentences)
+                while True:
+                    try:
+                        embeddings, error = encoded_queue.get(timeout=0.1)
+                        break
+                    except queue.Empty:
+                        if callback_errors:
+                            raise callback_errors[0]
+                        if not encode_thread.is_alive():
+                            # 向量化线程可能在超时之后、检查之前放入了最后一批
+                            try:
+                                embeddings, error = encoded_queue.get_nowait()
+                                break
+                            except queue.Empty:
+                                raise Exception('向量化线程异常退出')
+                if error is not None:
+                    raise error
+                with self.metrics.stage("write"):
+                    collection.add(
+                        documents=sentence_list[start_index:end_index],
+                        embeddings=embeddings,
+                        metadatas=metadatas_list[start_index:end_index],
+                        ids=ids_list[start_index:end_index])
+                if callback_errors:
+                    raise callback_errors[0]
+                self._advance_progress(i, num_batches, single_progress,
+                                       send_msg)
+                # 放入消息副本,send_msg后续还会被修改
+                if not self._put_until_stopped(callback_queue, dict(send_msg),
+                                               stop_event):
+                    raise callback_errors[0]
+        except BaseException:
+            stop_event.set()
+            raise
+        finally:
+            # 回调线程总在消费队列,这里阻塞放入结束标记不会卡住
+            callback_queue.put(None)
+            callback_thread.join()
+            encode_thread.join()
+        if callback_errors:
+            raise callback_errors[0]
+
+    def _fetch_neighbor_chunks(self, collection_name, metadatas_list,
+                               context_num):
+        """_批量获取命中片段的相邻片段_
+        按文件分组后只取需要的index,一次get取回,避免每个命中都拉取整份文件;
+        开启缓存时可缓存的文件整份拉取并缓存,无法缓存的文件仍按需取回
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            metadatas_list (_list_): _查找的相似度最高的metadatas元信息列表_
+            context_num (_int_): _上下文数量_
+        Returns:
+            _dict_: _{(file, index): (level, document)}_
+        """
+        neighbor_map = {}
+        if context_num < 1 or not metadatas_list:
+            return neighbor_map
+        # 按文件分组需要的相邻块index
+        wanted = {}
+        for item in metadatas_list:
+            s_index = int(item['index'])
+            wanted.setdefault(item['file'], set()).update(
+                s_index + val for val in range(1, context_num + 1))
+        if self.context_cache is not None:
+            layout_files = [
+                file for file in wanted
+                if self.context_cache.cacheable((collection_name, file))
+            ]
+            layouts = self._get_chunk_layouts(collection_name, layout_files)
+            for file in layout_files:
+                index_set = wanted.pop(file)
+                layout = layouts.get(file)
+                if layout is None:
+                    continue
+                for add_index in index_set:
+                    neighbor = layout.get(add_index)
+                    if neighbor is not None:
+                        neighbor_map[(file, add_index)] = neighbor
+            if not wanted:
+                return neighbor_map
+        conditions = [{
+            "$and": [{
+                "file": {
+                    "$eq": file
+                }
+            }, {
+                "index": {
+                    "$in": sorted(index_set)
+                }
+            }]
+        } for file, index_set in wanted.items()]
+        # chroma的$or要求至少两个条件
+        where = conditions[0] if len(conditions) == 1 else {"$or": conditions}
+        r = self._get_collection(collection_name).get(
+            where=where, include=["documents", "metadatas"])
+        self._count_fetched(r['documents'])
+        for metadata_item, document in zip(r['metadatas'], r['documents']):
+            neighbor_map[(metadata_item['file'],
+                          int(metadata_item['index']))] = (
+                              metadata_item['level'], document)
+        return neighbor_map
+
+    def _get_chunk_layouts(self, collection_name, files):
+        """_从缓存获取文件的片段布局,未命中的文件一次get批量拉取后写入缓存_
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            files (_list_): _文件名列表_
+        Returns:
+            _dict_: _{file: _ChunkLayout}_
+        """
+        layouts = {}
+        missing = []
+        for file in files:
+            layout = self.context_cache.get((collection_name, file))
+            if layout is None:
+                missing.append(file)
+            else:
+                layouts[file] = layout
+        if missing:
+            generations = {
+                file: self.context_cache.generation((collection_name, file))
+                for file in missing
+            }
+            r = self._get_collection(collection_name).get(
+                where=self._file_filter(missing),
+                include=["documents", "metadatas"])
+            self._count_fetched(r['documents'])
+            grouped = {}
+            for metadata_item, document in zip(r['metadatas'],
+                                               r['documents']):
+                metas, docs = grouped.setdefault(metadata_item['file'],
+                                                 ([], []))
+                metas.append(metadata_item)
+                docs.append(document)
+            for file, (metas, docs) in grouped.items():
+                layout = _ChunkLayout(metas, docs)
+                self.context_cache.put((collection_name, file), layout,
+                                       generations[file])
+                layouts[file] = layout
+        return layouts
 
     def get_context_milvus(self, collection_name, metadatas_list, result_list,
                            context_num):
@@ -255,42 +2472,22 @@ class MyMilvus:
             _list_: _拼接好的上下文列表_
         """
         try:
+            with self.metrics.stage("context"):
+                neighbor_map = self._fetch_neighbor_chunks(
+                    collection_name, metadatas_list, context_num)
             for index, item in enumerate(metadatas_list):
                 file = item['file']
                 s_index = int(item['index'])
-                # 找到此时分割到的块
-                # 找到上下文的块
-                add_indexs_list = [
-                    s_index + val for val in range(1, context_num + 1)
-                ]
-                # 找到该文件名的所有结果
-                r = self.collection.get(where={
-                    "file": {
-                        "$eq": file
-                    },
-                })
-                metadatas_new_list = r['metadatas']
-                document_list = r['documents']
-                document_length = len(document_list)
-                # print(document_list)
                 # 开始把相邻块的内容拼接上去
-                for add_index in add_indexs_list:
-                    # 从该文件中所有的数据进行筛选
-                    for meta_index, metadata_item in enumerate(
-                            metadatas_new_list):
-                        if metadata_item[
-                                'index'] == add_index and add_index < document_length:
-                            # print(meta_index)
-                            # print(index)
-                            result_list[index]['sentence'] += document_list[
-                                meta_index]
-                            # 找到此次的块之后就停止内循环
-                            break
-                # 放入该相似度的所有拼接内容
+                for val in range(1, context_num + 1):
+                    neighbor = neighbor_map.get((file, s_index + val))
+                    if neighbor is not None:
+                        result_list[index]['sentence'] += neighbor[1]
 
             return result_list
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
 
     def get_context_content(self, collection_name, metadatas_list, result_list,
                             context_num):
@@ -305,132 +2502,336 @@ class MyMilvus:
             _list_: _拼接好的上下文列表_
         """
         try:
+            with self.metrics.stage("context"):
+                neighbor_map = self._fetch_neighbor_chunks(
+                    collection_name, metadatas_list, context_num)
             for index, item in enumerate(metadatas_list):
                 file = item['file']
                 s_index = int(item['index'])
-                # 找到此时分割到的块
-                # 找到上下文的块
-                add_indexs_list = [
-                    s_index + val for val in range(1, context_num + 1)
-                ]
-                # 找到该文件名的所有结果
-                r = self.collection.get(where={
-                    "file": {
-                        "$eq": file
-                    },
-                })
-                metadatas_new_list = r['metadatas']
-                document_list = r['documents']
-                document_length = len(document_list)
-                # print(document_list)
-                # 开始把相邻块的内容拼接上去
-                # 是否停止
-                stop_flag = 0
-                for add_index in add_indexs_list:
-
-                    # 从该文件中所有的数据进行筛选
-                    for meta_index, metadata_item in enumerate(
-                            metadatas_new_list):
-                        # 这里只要level==0(即正文结果)
-                        if metadata_item[
-                                'index'] == add_index and add_index < document_length:
-                            if metadata_item['level'] == 0:
-                                result_list[index][
-                                    'sentence'] += document_list[meta_index]
-                            else:
-                                stop_flag += 1
-
-                            # 找到此次的块之后就停止内循环
-                            break
-
-                    if stop_flag > 0:
-                        # print(stop_flag)
+                for val in range(1, context_num + 1):
+                    neighbor = neighbor_map.get((file, s_index + val))
+                    if neighbor is None:
+                        continue
+                    # 这里只要level==0(即正文结果),遇到标题就停止拼接
+                    if neighbor[0] != 0:
                         break
+                    result_list[index]['sentence'] += neighbor[1]
 
-                # 放入该相似度的所有拼接内容
+            return result_list
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
+
+    def _count_fetched(self, documents):
+        """_记录从chroma取回的片段数与文本字节数_"""
+        if self.metrics.enabled:
+            self.metrics.count("chunks_fetched", len(documents))
+            self.metrics.count(
+                "document_bytes",
+                sum(len(document.encode("utf-8")) for document in documents))
+
+    @staticmethod
+    def _clean_text(text):
+        # 处理特殊字符
+        return text.translate(_CLEAN_TABLE).strip()
+
+    def _build_result_list(self,
+                           ids_list,
+                           document_list,
+                           metadatas_list,
+                           distance_list,
+                           keep_key_sentence,
+                           threshold,
+                           keep_ids=()):
+        """_把collection.query的单个结果集组装为结果列表,相似度不超过阈值的结果在拼接上下文之前就丢弃_
+        Args:
+            ids_list (_list_): _id列表_
+            document_list (_list_): _文本列表_
+            metadatas_list (_list_): _metadatas元信息列表_
+            distance_list (_list_): _距离列表_
+            keep_key_sentence (_bool_): _True时保留原文到key_sentence且sentence暂不清洗(无过滤条件的查询);False时直接清洗sentence_
+            threshold (_float_): _相似度阈值_
+            keep_ids (_set_, optional): _不受相似度阈值限制的id(如BM25命中)_
+        Returns:
+            _tuple_: _(SearchResult列表, 与之一一对应的metadatas列表)_
+        """
+        similarity = 1 - np.asarray(distance_list, dtype=np.float64)
+        keep_mask = similarity > threshold
+        if keep_ids:
+            keep_mask |= np.fromiter((id_item in keep_ids
+                                      for id_item in ids_list),
+                                     dtype=bool,
+                                     count=len(ids_list))
+        result_list = []
+        kept_metadatas = []
+        for document_index in np.flatnonzero(keep_mask).tolist():
+            document_item = document_list[document_index]
+            metadata = metadatas_list[document_index]
+            if keep_key_sentence:
+                sentence = key_sentence = document_item
+            else:
+                sentence = self._clean_text(document_item)
+                key_sentence = None
+            result_list.append(
+                SearchResult(ids_list[document_index], sentence,
+                             key_sentence, metadata,
+                             float(similarity[document_index])))
+            kept_metadatas.append(metadata)
+        return result_list, kept_metadatas
 
+    def _finish_result_list(self, result_list, keep_key_sentence,
+                            as_records):
+        """_清洗拼接好上下文的文本,按需转换为字典_"""
+        if keep_key_sentence:
+            for res in result_list:
+                res.sentence = self._clean_text(res.sentence)
+                res.key_sentence = self._clean_text(res.key_sentence)
+        if as_records:
             return result_list
+        return [res.to_dict() for res in result_list]
+
+    def _resolve_threshold(self, threshold):
+        return self.similarity_threshold if threshold is None else threshold
+
+    def _search_candidates(self, collection, collection_name, query,
+                           query_embeddings, limit_num, filter_expr, hybrid,
+                           rerank, started):
+        """_向量检索,开启混合检索时与BM25结果融合,开启重排时多取候选并重排_
+        Returns:
+            _tuple_: _(与collection.query相同结构的结果, 不受相似度阈值限制的id集合)_
+        """
+        return self._search_candidates_batch(collection, collection_name,
+                                             [query], query_embeddings,
+                                             limit_num, filter_expr, hybrid,
+                                             rerank, started)[0]
+
+    def _search_candidates_batch(self, collection, collection_name, queries,
+                                 query_embeddings, limit_num, filter_expr,
+                                 hybrid, rerank, started):
+        """_多个问题共用一次collection.query,之后逐个问题重打分、与BM25结果融合、重排_
+        Args:
+            queries (_list_): _问题文本列表_
+            query_embeddings (_np.ndarray_): _问题向量,与queries一一对应_
+            started (_float_): _开始查询的时间(time.perf_counter),重排的时间预算对整批问题生效_
+        Returns:
+            _list_: _每个问题一个(与collection.query相同结构的单问题结果, 不受相似度阈值限制的id集合)_
+        """
+        if hybrid is None:
+            hybrid = self.hybrid_search
+        if rerank is None:
+            rerank = self.reranker is not None and self.rerank_overfetch > 1
+        # 降维集合用变换后的问题向量检索,保留了原始向量时再重打分
+        transform = self._get_vector_transform(collection_name, collection)
+        if transform is not None and not transform.fitted:
+            transform = None
+        rescore = transform is not None and transform.keep_full
+        overfetch = 1
+        if rerank:
+            overfetch = max(overfetch, int(self.rerank_overfetch))
+        if rescore:
+            overfetch = max(overfetch, int(self.rescore_overfetch))
+        candidate_num = limit_num * overfetch
+        index_embeddings = query_embeddings
+        if transform is not None:
+            index_embeddings = transform.apply(query_embeddings)
+        n_results = candidate_num
+        if hybrid:
+            n_results = max(candidate_num, limit_num * 2)
+        with self.metrics.stage("query"):
+            batch_result = collection.query(query_embeddings=index_embeddings,
+                                            n_results=n_results,
+                                            where=filter_expr)
+        candidates = []
+        for query_index, query in enumerate(queries):
+            result = {
+                key: [values[query_index]]
+                for key, values in batch_result.items()
+                if key in ("ids", "documents", "metadatas", "distances",
+                           "embeddings") and values is not None
+            }
+            query_vector = query_embeddings[query_index:query_index + 1]
+            index_vector = index_embeddings[query_index:query_index + 1]
+            self._count_fetched(result['documents'][0])
+            # 先对向量候选重打分再融合,融合后的顺序由RRF决定
+            if rescore:
+                with self.metrics.stage("rescore"):
+                    result = self._rescore_full(collection_name, query_vector,
+                                                result)
+            keep_ids = ()
+            if hybrid:
+                with self.metrics.stage("lexical"):
+                    result, keep_ids = self._hybrid_fuse(
+                        collection, collection_name, query, index_vector,
+                        result, candidate_num, filter_expr)
+                if rescore:
+                    # 只被BM25召回的片段距离按降维向量计算,这里换成原始精度(不改变顺序)
+                    result['distances'] = [
+                        self._full_distances(collection_name, query_vector,
+                                             result)
+                    ]
+            if rerank:
+                with self.metrics.stage("rerank"):
+                    result = self._rerank(collection, query, index_vector,
+                                          result, limit_num, started)
+            elif overfetch > 1:
+                result = self._take_result(
+                    result, range(min(len(result['ids'][0]), limit_num)))
+            candidates.append((result, keep_ids))
+        return candidates
+
+    @staticmethod
+    def _take_result(result, order):
+        """_按order重新排列/截取单个结果集_"""
+        taken = {}
+        for key in ("ids", "documents", "metadatas", "distances",
+                    "embeddings"):
+            values = result.get(key)
+            if values is not None and len(values) and values[0] is not None:
+                taken[key] = [[values[0][i] for i in order]]
+        return taken
+
+    def _rerank(self, collection, query, query_embeddings, result, limit_num,
+                started):
+        """_对候选结果重排,返回前limit_num条_
+        超过时间预算或重排出错时退化为原有顺序的前limit_num条
+        Args:
+            collection (_Collection_): _集合句柄_
+            query (_str_): _问题文本_
+            query_embeddings (_np.ndarray_): _问题向量_
+            result (_QueryResult_): _候选结果_
+            limit_num (_int_): _返回条数_
+            started (_float_): _查询开始时间(time.perf_counter)_
+        Returns:
+            _QueryResult_: _重排后的结果_
+        """
+        candidate_num = len(result['ids'][0])
+        if candidate_num <= 1 or self.reranker is None:
+            return self._take_result(result, range(min(candidate_num,
+                                                       limit_num)))
+        if self.rerank_time_budget_ms is not None and (
+                time.perf_counter() -
+                started) * 1000 > self.rerank_time_budget_ms:
+            return self._take_result(result, range(min(candidate_num,
+                                                       limit_num)))
+        try:
+            if self.reranker == "mmr":
+                order = self._mmr_order(collection, query_embeddings, result,
+                                        limit_num)
+            else:
+                scores = self.reranker.predict([
+                    (query, document) for document in result['documents'][0]
+                ])
+                order = np.argsort(-np.asarray(scores,
+                                               dtype=np.float64),
+                                   kind="stable")[:limit_num].tolist()
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
+            order = range(min(candidate_num, limit_num))
+        return self._take_result(result, order)
 
+    def _mmr_order(self, collection, query_embeddings, result, limit_num):
+        """_MMR(最大边际相关)多样性排序,使用候选结果的向量_
+        Returns:
+            _list_: _选中的候选位置_
+        """
+        embeddings = result.get('embeddings')
+        if embeddings is None or not len(
+                embeddings) or embeddings[0] is None:
+            r = collection.get(ids=result['ids'][0], include=["embeddings"])
+            by_id = dict(zip(r['ids'], r['embeddings']))
+            embeddings = [[by_id[id_item] for id_item in result['ids'][0]]]
+        vectors = np.asarray(embeddings[0], dtype=np.float32)
+        relevance = vectors @ np.asarray(query_embeddings[0],
+                                         dtype=np.float32)
+        similarity = vectors @ vectors.T
+        selected = [int(np.argmax(relevance))]
+        max_similarity = similarity[selected[0]].copy()
+        remaining = np.ones(len(vectors), dtype=bool)
+        remaining[selected[0]] = False
+        while len(selected) < limit_num and remaining.any():
+            scores = (self.mmr_lambda * relevance -
+                      (1 - self.mmr_lambda) * max_similarity)
+            scores[~remaining] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            remaining[best] = False
+            np.maximum(max_similarity, similarity[best], out=max_similarity)
+        return selected
+
+    @instrumented
     def similarity_query_hybrid_search(self,
                                        collection_name,
                                        query,
-                                       limit_num=1):
+                                       limit_num=1,
+                                       hybrid=None,
+                                       threshold=None,
+                                       as_records=False,
+                                       rerank=None):
         """_通过问题文本混合查找相似度(没有过滤条件)_
 
         Args:
             collection_name (_type_): _集合(空间名称)_
             query (_str_): _问题文本_
             limit_num (int, optional): _返回相似项的条数_. Defaults to 1.
+            hybrid (_bool_, optional): _是否融合BM25检索结果_. Defaults to None,取self.hybrid_search.
+            threshold (_float_, optional): _相似度阈值_. Defaults to None,取self.similarity_threshold.
+            as_records (_bool_, optional): _返回SearchResult而不是字典_. Defaults to False.
+            rerank (_bool_, optional): _是否多取候选并重排_. Defaults to None,配置了reranker且rerank_overfetch>1时开启.
 
         Returns:
-            _type_: _description_
+            _list_: _表示返回的相关内容的列表_
         """
         try:
             if query:
-                self.load_collection(collection_name)
-                # print(f"query: {query}")
-                query_embeddings = self.embeddings.encode(
-                    [query], normalize_embeddings=True)
-                # print(
-                #     f"query_embeddings of length : {len(query_embeddings[0])}")
-                result = self.collection.query(
-                    query_embeddings=query_embeddings, n_results=limit_num)
+                started = time.perf_counter()
+                cache_key, version, cached = self._lookup_result_cache(
+                    "query", collection_name, query, limit_num,
+                    mcfg.CONTEXT_NUM, hybrid, threshold, as_records, rerank)
+                if cached is not None:
+                    self.metrics.count("cache_hits")
+                    return cached
+                collection = self._get_collection(collection_name)
+                query_embeddings = self._encode_query(query)
+                result, keep_ids = self._search_candidates(
+                    collection, collection_name, query, query_embeddings,
+                    limit_num, None, hybrid, rerank, started)
                 # 这里因为id是不连续的，所以返回metadatas中的file 与 index即可锁定上下文返回
-                metadatas_list = result['metadatas'][0]
-                # metadatas_list为一个列表，包含着匹配到的每一个相似的数据项的metadatas值
-                document_list = result['documents'][0]
-                distance_list = result["distances"][0]
-                ids_list = result["ids"][0]
-                # print(distance_list)
-                result_list = []
-                for document_index, document_item in enumerate(document_list):
-                    result_item = {}
-                    result_item['id'] = ids_list[document_index]
-                    result_item['sentence'] = document_item
-                    result_item['key_sentence'] = document_item
-                    result_item['is_title'] = metadatas_list[document_index][
-                        'is_title']
-                    result_item['is_head'] = metadatas_list[document_index][
-                        'is_head']
-                    result_item['level'] = metadatas_list[document_index][
-                        'level']
-                    result_item['outline'] = metadatas_list[document_index][
-                        'outline']
-                    result_item['index'] = metadatas_list[document_index][
-                        'index']
-                    result_item['file'] = metadatas_list[document_index][
-                        'file']
-                    result_item['distance'] = 1 - distance_list[document_index]
-
-                    result_list.append(result_item)
+                # metadatas_list为一个列表，包含着通过阈值的每一个相似的数据项的metadatas值
+                with self.metrics.stage("postprocess"):
+                    result_list, metadatas_list = self._build_result_list(
+                        result["ids"][0], result['documents'][0],
+                        result['metadatas'][0], result["distances"][0], True,
+                        self._resolve_threshold(threshold), keep_ids)
                 result_list = self.get_context_milvus(collection_name,
                                                       metadatas_list,
                                                       result_list,
                                                       mcfg.CONTEXT_NUM)
-                # 处理特殊字符
-                result_list = [
-                    item for item in result_list if item['distance'] > 0.4
-                ]
-                for res in result_list:
-                    res["sentence"] = res["sentence"].replace(
-                        "\xa0", "").replace("\n", "").strip()
-                    res["key_sentence"] = res["key_sentence"].replace(
-                        "\xa0", "").replace("\n", "").strip()
+                with self.metrics.stage("postprocess"):
+                    result_list = self._finish_result_list(
+                        result_list, True, as_records)
+                self.metrics.count("results", len(result_list))
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, version, result_list)
                 return result_list
 
             else:
                 raise Exception('问题不能为空')
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
 
+    @instrumented
     def similarity_filter_hybrid_search(self,
                                         collection_name,
                                         query,
                                         filter_expr,
                                         limit_num=1,
-                                        context_num=2):
+                                        context_num=2,
+                                        hybrid=None,
+                                        threshold=None,
+                                        as_records=False,
+                                        rerank=None):
         """_通过问题文本混合查找相似度(有过滤条件)_
 
         Args:
@@ -439,6 +2840,10 @@ class MyMilvus:
             filter_expr(_str_):过滤条件，例如(is_title==1)表示过滤掉is_title==1的数据项
             limit_num (int, optional): _int_. Defaults to 1.取相似的前几个问题
             context_num=2 表示要的相邻上下文的数据项数量
+            hybrid (_bool_, optional): _是否融合BM25检索结果_. Defaults to None,取self.hybrid_search.
+            threshold (_float_, optional): _相似度阈值_. Defaults to None,取self.similarity_threshold.
+            as_records (_bool_, optional): _返回SearchResult而不是字典_. Defaults to False.
+            rerank (_bool_, optional): _是否多取候选并重排_. Defaults to None,配置了reranker且rerank_overfetch>1时开启.
         Returns:
             _list_: _表示返回的相关内容的列表_
         """
@@ -446,54 +2851,115 @@ class MyMilvus:
         # 表示返回的数据项中需要metadatas中的is_title属性不等于1
         try:
             if query:
-                self.load_collection(collection_name)
-                query_embeddings = self.embeddings.encode(
-                    [query], normalize_embeddings=True)
-                result = self.collection.query(
-                    query_embeddings=query_embeddings,
-                    n_results=limit_num,
-                    where=filter_expr)
+                started = time.perf_counter()
+                cache_key, version, cached = self._lookup_result_cache(
+                    "filter", collection_name, query, filter_expr, limit_num,
+                    context_num, hybrid, threshold, as_records, rerank)
+                if cached is not None:
+                    self.metrics.count("cache_hits")
+                    return cached
+                collection = self._get_collection(collection_name)
+                query_embeddings = self._encode_query(query)
+                result, keep_ids = self._search_candidates(
+                    collection, collection_name, query, query_embeddings,
+                    limit_num, filter_expr, hybrid, rerank, started)
                 # 这里因为id是不连续的，所以返回metadatas中的file 与 index即可锁定上下文返回
-                metadatas_list = result['metadatas'][0]
-                # metadatas_list为一个列表，包含着匹配到的每一个相似的数据项的metadatas值
-                docment_list = result['documents'][0]
-                distance_list = result["distances"][0]
-                ids_list = result["ids"][0]
-                # print(distance_list)
-                result_list = []
-                for document_index, document_item in enumerate(docment_list):
-                    result_item = {}
-                    result_item['id'] = ids_list[document_index]
-                    result_item['sentence'] = document_item.replace(
-                        "\xa0", "").replace("\n", "").strip()
-                    result_item['is_title'] = metadatas_list[document_index][
-                        'is_title']
-                    result_item['is_head'] = metadatas_list[document_index][
-                        'is_head']
-                    result_item['level'] = metadatas_list[document_index][
-                        'level']
-                    result_item['outline'] = metadatas_list[document_index][
-                        'outline']
-                    result_item['index'] = metadatas_list[document_index][
-                        'index']
-                    result_item['file'] = metadatas_list[document_index][
-                        'file']
-                    result_item['distance'] = 1 - distance_list[document_index]
-
-                    result_list.append(result_item)
-
-                # document_list为一个列表，包含着匹配到的每一个相似的数据项的document(正文)值
-                # print(docment_list)
+                with self.metrics.stage("postprocess"):
+                    result_list, metadatas_list = self._build_result_list(
+                        result["ids"][0], result['documents'][0],
+                        result['metadatas'][0], result["distances"][0], False,
+                        self._resolve_threshold(threshold), keep_ids)
                 if context_num > 1:
                     result_list = self.get_context_content(
                         collection_name, metadatas_list, result_list,
                         context_num)
-                result_list = [
-                    item for item in result_list if item['distance'] > 0.4
-                ]
+                with self.metrics.stage("postprocess"):
+                    result_list = self._finish_result_list(
+                        result_list, False, as_records)
+                self.metrics.count("results", len(result_list))
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, version, result_list)
                 return result_list
 
             else:
                 raise Exception('问题不能为空')
         except Exception as e:
             print(traceback.format_exc())
+            self.metrics.error(e)
+
+    @instrumented
+    def similarity_query_batch(self,
+                               collection_name,
+                               queries,
+                               limit_num=1,
+                               filter_expr=None,
+                               context_num=None,
+                               threshold=None,
+                               as_records=False,
+                               hybrid=None,
+                               rerank=None):
+        """_批量问题查找相似度,一次向量化、一次collection.query_
+        filter_expr为None时每个问题的结果与similarity_query_hybrid_search一致,
+        否则与similarity_filter_hybrid_search一致(包括BM25融合与重排,二者逐个问题进行)
+        Args:
+            collection_name (_str_): _集合(空间名称)_
+            queries (_list_): _问题文本列表_
+            limit_num (int, optional): _每个问题返回相似项的条数_. Defaults to 1.
+            filter_expr (_dict_, optional): _过滤条件_. Defaults to None.
+            context_num (_int_, optional): _上下文数量_. Defaults to None,无过滤条件时取mcfg.CONTEXT_NUM,有过滤条件时取2.
+            threshold (_float_, optional): _相似度阈值_. Defaults to None,取self.similarity_threshold.
+            as_records (_bool_, optional): _返回SearchResult而不是字典_. Defaults to False.
+            hybrid (_bool_, optional): _是否融合BM25检索结果_. Defaults to None,取self.hybrid_search.
+            rerank (_bool_, optional): _是否多取候选并重排_. Defaults to None,配置了reranker且rerank_overfetch>1时开启.
+        Returns:
+            _list_: _每个问题对应一个结果列表_
+        """
+        try:
+            if queries and all(queries):
+                started = time.perf_counter()
+                queries = list(queries)
+                keep_key_sentence = filter_expr is None
+                if context_num is None:
+                    context_num = mcfg.CONTEXT_NUM if keep_key_sentence else 2
+                collection = self._get_collection(collection_name)
+                with self.metrics.stage("encode"):
+                    query_embeddings = self.embeddings.encode(
+                        queries, normalize_embeddings=True)
+                candidates = self._search_candidates_batch(
+                    collection, collection_name, queries, query_embeddings,
+                    limit_num, filter_expr, hybrid, rerank, started)
+                # 所有问题的结果合并到一起,共用一次上下文拼接
+                batch_result_lists = []
+                all_metadatas = []
+                all_results = []
+                threshold = self._resolve_threshold(threshold)
+                with self.metrics.stage("postprocess"):
+                    for result, keep_ids in candidates:
+                        result_list, metadatas_list = self._build_result_list(
+                            result["ids"][0], result['documents'][0],
+                            result['metadatas'][0], result["distances"][0],
+                            keep_key_sentence, threshold, keep_ids)
+                        batch_result_lists.append(result_list)
+                        all_metadatas += metadatas_list
+                        all_results += result_list
+                # 原地拼接上下文后各问题的结果列表同步更新
+                if keep_key_sentence:
+                    self.get_context_milvus(collection_name, all_metadatas,
+                                            all_results, context_num)
+                elif context_num > 1:
+                    self.get_context_content(collection_name, all_metadatas,
+                                             all_results, context_num)
+                self.metrics.count("queries", len(queries))
+                self.metrics.count("results", len(all_results))
+                with self.metrics.stage("postprocess"):
+                    return [
+                        self._finish_result_list(result_list,
+                                                 keep_key_sentence, as_records)
+                        for result_list in batch_result_lists
+                    ]
+
+            else:
+                raise Exception('问题不能为空')
+        except Exception as e:
+            print(traceback.format_exc())
+            self.metrics.error(e)
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   my_metrics.py
+@Version :   1.0
+@Desc    :   MyMilvus各操作的耗时、计数与错误统计
+'''
+import contextvars
+import functools
+import http.server
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+# 默认的耗时直方图桶(毫秒)
+DEFAULT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000,
+                      5000, 10000, 30000)
+
+# 当前线程/协程正在执行的操作
+_current_operation = contextvars.ContextVar("my_milvus_operation",
+                                            default=None)
+
+
+class Histogram:
+    """_简单的累计直方图,buckets为各个桶的上界_"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {}
+            total = 0
+            for upper, count in zip(self.buckets + ("+Inf", ), self.counts):
+                total += count
+                buckets[upper] = total
+            return {"buckets": buckets, "count": self.count, "sum": self.sum}
+
+    def quantile(self, q):
+        """_按桶上界估算分位数_"""
+        with self._lock:
+            if not self.count:
+                return None
+            target = q * self.count
+            total = 0
+            for upper, count in zip(self.buckets, self.counts):
+                total += count
+                if total >= target:
+                    return upper
+            return float("inf")
+
+
+class MetricsSink:
+    """_指标接收端接口,自定义接收端(如上报到其他监控系统)继承该类_"""
+
+    def record_duration(self, operation, stage, seconds):
+        pass
+
+    def record_count(self, operation, name, value):
+        pass
+
+    def record_error(self, operation, error_type):
+        pass
+
+    def record_trace(self, trace):
+        pass
+
+
+class InMemoryMetrics(MetricsSink):
+    """_进程内指标:各操作各阶段的耗时直方图、计数、错误数,以及最近的请求追踪记录_"""
+
+    def __init__(self, buckets_ms=DEFAULT_BUCKETS_MS, max_traces=1000):
+        self.buckets_ms = tuple(buckets_ms)
+        self.histograms = {}
+        self.counters = {}
+        self.errors = {}
+        self.traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def record_duration(self, operation, stage, seconds):
+        key = (operation, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(
+                    key, Histogram(self.buckets_ms))
+        histogram.observe(seconds * 1000)
+
+    def record_count(self, operation, name, value):
+        with self._lock:
+            key = (operation, name)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record_error(self, operation, error_type):
+        with self._lock:
+            key = (operation, error_type)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def record_trace(self, trace):
+        self.traces.append(trace)
+
+    def snapshot(self):
+        """_当前指标的字典形式_"""
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+            errors = dict(self.errors)
+        result = {}
+        for (operation, stage), histogram in histograms.items():
+            snapshot = histogram.snapshot()
+            result.setdefault(operation, {}).setdefault("stages", {})[stage] = {
+                "count": snapshot["count"],
+                "sum_ms": snapshot["sum"],
+                "p50_ms": histogram.quantile(0.5),
+                "p95_ms": histogram.quantile(0.95),
+                "p99_ms": histogram.quantile(0.99)
+            }
+        for (operation, name), value in counters.items():
+            result.setdefault(operation, {}).setdefault("counts",
+                                                        {})[name] = value
+        for (operation, error_type), value in errors.items():
+            result.setdefault(operation, {}).setdefault("errors",
+                                                        {})[error_type] = value
+        return result
+
+    def to_prometheus_text(self, prefix="my_milvus"):
+        """_导出为Prometheus文本格式_"""
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            errors = sorted(self.errors.items())
+        lines = [
+            f"# HELP {prefix}_stage_duration_ms 各操作各阶段耗时(毫秒)",
+            f"# TYPE {prefix}_stage_duration_ms histogram"
+        ]
+        for (operation, stage), histogram in histograms:
+            labels = f'operation="{operation}",stage="{stage}"'
+            snapshot = histogram.snapshot()
+            for upper, total in snapshot["buckets"].items():
+                lines.append(f'{prefix}_stage_duration_ms_bucket'
+                             f'{{{labels},le="{upper}"}} {total}')
+            lines.append(f"{prefix}_stage_duration_ms_sum{{{labels}}} "
+                         f"{snapshot['sum']}")
+            lines.append(f"{prefix}_stage_duration_ms_count{{{labels}}} "
+                         f"{snapshot['count']}")
+        lines += [
+            f"# HELP {prefix}_items_total 各操作处理的条目数",
+            f"# TYPE {prefix}_items_total counter"
+        ]
+        for (operation, name), value in counters:
+            lines.append(f'{prefix}_items_total{{operation="{operation}",'
+                         f'name="{name}"}} {value}')
+        lines += [
+            f"# HELP {prefix}_errors_total 各操作的错误数",
+            f"# TYPE {prefix}_errors_total counter"
+        ]
+        for (operation, error_type), value in errors:
+            lines.append(f'{prefix}_errors_total{{operation="{operation}",'
+                         f'error="{error_type}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+class PrometheusTextExporter:
+    """_把InMemoryMetrics定期写入文本文件(供node_exporter textfile采集),或通过本地HTTP端口提供_"""
+
+    def __init__(self, metrics: InMemoryMetrics, prefix="my_milvus"):
+        self.metrics = metrics
+        self.prefix = prefix
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._server = None
+
+    def write_file(self, path):
+        """_写入一次(先写临时文件再替换)_"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.metrics.to_prometheus_text(self.prefix))
+        os.replace(tmp_path, path)
+
+    def start(self, path=None, interval=15, port=None, host="127.0.0.1"):
+        """_启动后台导出_
+        Args:
+            path (_str_, optional): _定期写入的文件路径_
+            interval (int, optional): _写文件的间隔(秒)_. Defaults to 15.
+            port (_int_, optional): _提供/metrics的HTTP端口_
+            host (str, optional): _HTTP监听地址_. Defaults to "127.0.0.1".
+        """
+        if path:
+
+            def write_loop():
+                while not self._stop_event.wait(interval):
+                    try:
+                        self.write_file(path)
+                    except OSError as e:
+                        print(f"metrics export failed: {e}")
+
+            thread = threading.Thread(target=write_loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if port is not None:
+            exporter = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    body = exporter.metrics.to_prometheus_text(
+                        exporter.prefix).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type",
+                                     "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = http.server.ThreadingHTTPServer((host, port),
+                                                           Handler)
+            thread = threading.Thread(target=self._server.serve_forever,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _OperationRecord:
+    """_一次操作的阶段耗时与计数,操作结束时汇总_"""
+    __slots__ = ('name', 'started', 'started_at', 'stages', 'counts',
+                 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.stages = {}
+        self.counts = {}
+        self.error = None
+
+
+class _StageTimer:
+    __slots__ = ('instrumentation', 'record', 'stage', 'started')
+
+    def __init__(self, instrumentation, record, stage):
+        self.instrumentation = instrumentation
+        self.record = record
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        record = self.record
+        record.stages[self.stage] = record.stages.get(self.stage, 0) + elapsed
+        for sink in self.instrumentation.sinks:
+            sink.record_duration(record.name, self.stage, elapsed)
+        return False
+
+
+class _OperationTimer:
+    __slots__ = ('instrumentation', 'record', 'token')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.record = _OperationRecord(name)
+
+    def __enter__(self):
+        self.token = _current_operation.set(self.record)
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_operation.reset(self.token)
+        if exc is not None:
+            self.instrumentation.error(exc, self.record)
+        self.instrumentation.finish(self.record)
+        return False
+
+
+class Instrumentation:
+    """_MyMilvus使用的埋点入口,把阶段耗时、计数、错误分发给各个接收端_"""
+
+    enabled = True
+
+    def __init__(self, sinks, trace=False):
+        """_初始化_
+        Args:
+            sinks (_list_): _MetricsSink列表_
+            trace (bool, optional): _是否为每次请求生成追踪记录_. Defaults to False.
+        """
+        self.sinks = list(sinks)
+        self.trace = trace
+
+    def current(self):
+        """_当前线程/协程正在执行的操作记录,传给后台线程使用_"""
+        return _current_operation.get()
+
+    def operation(self, name):
+        """_记录一次操作,操作内的stage/count/error归属于该操作_"""
+        return _OperationTimer(self, name)
+
+    def stage(self, stage, record=None):
+        """_记录操作中某个阶段的耗时_
+        Args:
+            stage (_str_): _阶段名,如resolve/encode/query/context/postprocess/callback_
+            record (_OperationRecord_, optional): _所属操作,后台线程中需显式传入_
+        """
+        record = record or _current_operation.get()
+        if record is None:
+            return _NULL_TIMER
+        return _StageTimer(self, record, stage)
+
+    def count(self, name, value=1, record=None):
+        record = record or _current_operation.get()
+        if record is None:
+            return
+        record.counts[name] = record.counts.get(name, 0) + value
+        for sink in self.sinks:
+            sink.record_count(record.name, name, value)
+
+    def error(self, exc, record=None):
+        record = record or _current_operation.get()
+        operation = record.name if record is not None else "unknown"
+        if record is not None:
+            record.error = type(exc).__name__
+        for sink in self.sinks:
+            sink.record_error(operation, type(exc).__name__)
+
+    def finish(self, record):
+        elapsed = time.perf_counter() - record.started
+        for sink in self.sinks:
+            sink.record_duration(record.name, "total", elapsed)
+            sink.record_count(record.name, "calls", 1)
+        if self.trace:
+            trace = {
+                "operation": record.name,
+                "started_at": record.started_at,
+                "duration_ms": elapsed * 1000,
+                "stages_ms": {
+                    stage: seconds * 1000
+                    for stage, seconds in record.stages.items()
+                },
+                "counts": dict(record.counts),
+                "error": record.error
+            }
+            for sink in self.sinks:
+                sink.record_trace(trace)
+
+
+class _NullInstrumentation:
+    """_关闭埋点时使用,所有方法为空操作_"""
+
+    enabled = False
+    trace = False
+    sinks = ()
+
+    def current(self):
+        return None
+
+    def operation(self, name):
+        return _NULL_TIMER
+
+    def stage(self, stage, record=None):
+        return _NULL_TIMER
+
+    def count(self, name, value=1, record=None):
+        pass
+
+    def error(self, exc, record=None):
+        pass
+
+
+NULL_INSTRUMENTATION = _NullInstrumentation()
+
+
+def instrumented(method):
+    """_把MyMilvus的公开方法记录为一次操作,已在操作中时(嵌套调用)直接执行_"""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if not metrics.enabled or _current_operation.get() is not None:
+            return method(self, *args, **kwargs)
+        with metrics.operation(name):
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   test_collection_registry.py
+@Version :   1.0
+@Desc    :   集合在其他进程中被删除重建后,缓存的句柄重新解析
+'''
+import os
+import sys
+import pytest
+
+pytest.importorskip("chromadb")
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "benchmarks"))
+import bench_my_chromadb as bench  # noqa: E402
+
+my_chromadb = bench.load_module(None)
+
+COLLECTION = "test_collection"
+
+
+def _chunks(file, count):
+    return [
+        bench.SyntheticChunk(f"{file} 第{i}段 PX-{1000 + i}", file, i, 0, "")
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("num_shards", [1, 2])
+def test_recreated_collection_is_resolved_again(tmp_path, num_shards):
+    worker = my_chromadb.MyMilvus(str(tmp_path),
+                                  bench.FakeEmbedder(dim=64),
+                                  num_shards=num_shards)
+    worker.create_collection(COLLECTION)
+    worker.add_document(_chunks("a.pdf", 5), COLLECTION, None,
+                        {"progress": 0})
+    assert len(worker.query_by_file(COLLECTION, "a.pdf")) == 5
+
+    other = my_chromadb.MyMilvus(str(tmp_path),
+                                 bench.FakeEmbedder(dim=64),
+                                 num_shards=num_shards)
+    other.delete_milvus_table(COLLECTION)
+    other.create_collection(COLLECTION)
+    other.add_document(_chunks("b.pdf", 3), COLLECTION, None,
+                       {"progress": 0})
+
+    assert worker.query_by_file(COLLECTION, "a.pdf") == []
+    assert len(worker.query_by_file(COLLECTION, "b.pdf")) == 3
+
+    other.delete_milvus_table(COLLECTION)
+    with pytest.raises(Exception, match="has not exsit"):
+        worker.collections.get(COLLECTION).count()
+    assert COLLECTION not in worker.collections._handles
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   test_context_cache.py
+@Version :   1.0
+@Desc    :   上下文拼接的片段布局缓存
+'''
+import os
+import sys
+import pytest
+
+pytest.importorskip("chromadb")
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "benchmarks"))
+import bench_my_chromadb as bench  # noqa: E402
+
+my_chromadb = bench.load_module(None)
+
+COLLECTION = "test_collection"
+
+
+def _build(path, total_chunks, per_file, **kwargs):
+    corpus = bench.generate_corpus(total_chunks, per_file, per_file, seed=0)
+    docs = [chunk for chunks in corpus.values() for chunk in chunks]
+    milvus = my_chromadb.MyMilvus(str(path), bench.FakeEmbedder(dim=64),
+                                  **kwargs)
+    milvus.create_collection(COLLECTION)
+    milvus.add_document(docs, COLLECTION, None, {"progress": 0})
+    return milvus, docs
+
+
+def _count_fetched(milvus, monkeypatch):
+    fetched = []
+    monkeypatch.setattr(milvus, "_count_fetched",
+                        lambda documents: fetched.append(len(documents)))
+    return fetched
+
+
+def test_oversized_layouts_fall_back_to_index_fetch(tmp_path, monkeypatch):
+    milvus, docs = _build(tmp_path, 600, 300, context_cache_bytes=20 * 1024)
+    fetched = _count_fetched(milvus, monkeypatch)
+    for doc in docs[10:15]:
+        assert milvus.similarity_filter_hybrid_search(COLLECTION,
+                                                      doc.sentence[:30],
+                                                      {"is_title": {
+                                                          "$ne": 1
+                                                      }},
+                                                      3,
+                                                      threshold=0)
+    # 只有第一次查询整份拉取各文件(600条),之后按index取回相邻片段;
+    # 每次都整份拉取时为5 * 600条
+    assert sum(fetched) < 2 * 600
+    assert milvus.context_cache_stats()["bypassed"] == 2
+
+
+def test_layout_read_before_invalidation_is_not_cached(tmp_path):
+    milvus, docs = _build(tmp_path, 20, 10)
+    file = docs[0].metadata["source"]
+    key = (COLLECTION, file)
+    collection = milvus._get_collection(COLLECTION)
+
+    class InvalidatedDuringRead:
+        """_读取期间文件被修改_"""
+
+        def get(self, **kwargs):
+            r = collection.get(**kwargs)
+            milvus.context_cache.invalidate(COLLECTION, file)
+            return r
+
+    milvus._get_collection = lambda name: InvalidatedDuringRead()
+    layouts = milvus._get_chunk_layouts(COLLECTION, [file])
+    assert layouts[file].get(0) is not None
+    assert milvus.context_cache.get(key) is None
+    # 两次查询之间没有再被修改,下一次查询重新缓存
+    del milvus._get_collection
+    assert milvus.context_cache.cacheable(key)
+    milvus._get_chunk_layouts(COLLECTION, [file])
+    assert milvus.context_cache.get(key) is not None
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   test_hybrid_search.py
+@Version :   1.0
+@Desc    :   BM25索引与混合检索
+'''
+import os
+import sys
+import threading
+import pytest
+
+pytest.importorskip("chromadb")
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "benchmarks"))
+import bench_my_chromadb as bench  # noqa: E402
+
+my_chromadb = bench.load_module(None)
+
+COLLECTION = "test_collection"
+
+
+def _files(total_chunks, seed):
+    corpus = bench.generate_corpus(total_chunks, 5, 20, seed=seed)
+    # 不同seed生成的文件名相同,加上前缀区分
+    return {
+        f"{seed}_{file}": [
+            bench.SyntheticChunk(chunk.sentence, f"{seed}_{file}",
+                                 chunk.metadata["chunk_num"], chunk.level,
+                                 chunk.outline) for chunk in chunks
+        ]
+        for file, chunks in corpus.items()
+    }
+
+
+def _add(milvus, files):
+    for chunks in files.values():
+        milvus.add_document(chunks, COLLECTION, None, {"progress": 0})
+
+
+def test_per_call_hybrid_index_follows_changes(tmp_path):
+    milvus = my_chromadb.MyMilvus(str(tmp_path), bench.FakeEmbedder(dim=64))
+    milvus.create_collection(COLLECTION)
+    first = _files(20, seed=0)
+    _add(milvus, first)
+    # hybrid_search未开启,单次查询传入hybrid=True建立索引
+    assert milvus.similarity_query_hybrid_search(COLLECTION,
+                                                 "PX-1234",
+                                                 3,
+                                                 hybrid=True,
+                                                 threshold=0) is not None
+    assert milvus.load_lexical_index(COLLECTION)
+    index = milvus._lexical_indexes[COLLECTION]
+    assert len(index) == 20
+
+    second = _files(20, seed=1)
+    _add(milvus, second)
+    collection = milvus._get_collection(COLLECTION)
+    assert len(index) == collection.count() == 40
+    new_chunk = list(second.values())[0][3]
+    code = new_chunk.sentence.split()[-1]
+    hits = index.search(code, 5)
+    assert new_chunk.metadata["source"] in [file for _, file, _ in hits]
+
+    milvus.delete_documents(COLLECTION, list(first))
+    assert len(index) == collection.count() == 20
+    assert not set(first) & {file for _, file, _ in index.search(code, 40)}
+
+
+def test_lexical_index_builds_in_background(tmp_path, monkeypatch):
+    milvus = my_chromadb.MyMilvus(str(tmp_path),
+                                  bench.FakeEmbedder(dim=64),
+                                  hybrid_search=True)
+    milvus.create_collection(COLLECTION)
+    first = _files(20, seed=0)
+    _add(milvus, first)
+
+    release = threading.Event()
+
+    class SlowIndex(my_chromadb.BM25Index):
+        """_构建时阻塞,直到测试放行_"""
+
+        def add(self, *args):
+            release.wait(10)
+            return super().add(*args)
+
+    monkeypatch.setattr(my_chromadb, "BM25Index", SlowIndex)
+    query = list(first.values())[0][3].sentence[:30]
+    # 构建期间只使用向量检索,不等待索引
+    result = milvus.similarity_query_hybrid_search(COLLECTION,
+                                                   query,
+                                                   3,
+                                                   threshold=0)
+    assert len(result) == 3
+    assert COLLECTION not in milvus._lexical_indexes
+    assert not milvus.load_lexical_index(COLLECTION, timeout=0.1)
+
+    # 构建期间的写入在索引发布前补读
+    second = _files(20, seed=1)
+    release_later = threading.Timer(0.5, release.set)
+    release_later.start()
+    _add(milvus, second)
+    milvus.delete_documents(COLLECTION, list(first)[:1])
+    assert milvus.load_lexical_index(COLLECTION, timeout=10)
+    index = milvus._lexical_indexes[COLLECTION]
+    assert len(index) == milvus._get_collection(COLLECTION).count()
+    assert not set(list(first)[:1]) & set(index.file_docs)
+    assert set(second) <= set(index.file_docs)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {
+    "reranker": "mmr",
+    "rerank_overfetch": 3
+}])
+def test_batch_matches_single_search(tmp_path, kwargs):
+    milvus = my_chromadb.MyMilvus(str(tmp_path),
+                                  bench.FakeEmbedder(dim=64),
+                                  hybrid_search=True,
+                                  **kwargs)
+    milvus.create_collection(COLLECTION)
+    files = _files(300, seed=0)
+    _add(milvus, files)
+    assert milvus.load_lexical_index(COLLECTION)
+    docs = [chunk for chunks in files.values() for chunk in chunks]
+    queries = [docs[10].sentence.split()[-1], docs[50].sentence[:20]]
+    batch = milvus.similarity_query_batch(COLLECTION,
+                                          queries,
+                                          3,
+                                          threshold=0)
+    single = [
+        milvus.similarity_query_hybrid_search(COLLECTION,
+                                              query,
+                                              3,
+                                              threshold=0)
+        for query in queries
+    ]
+    strip = lambda results: [[{
+        key: value
+        for key, value in item.items() if key != "id"
+    } for item in result] for result in results]
+    assert strip(batch) == strip(single)
+    if not kwargs:
+        # 型号只出现在这一个片段中,由BM25召回
+        assert docs[10].metadata["chunk_num"] in [
+            item["index"] for item in batch[0]
+        ]
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   test_pipelined_ingest.py
+@Version :   1.0
+@Desc    :   流水线入库
+'''
+import os
+import queue
+import sys
+import time
+import types
+import pytest
+
+pytest.importorskip("chromadb")
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "benchmarks"))
+import bench_my_chromadb as bench  # noqa: E402
+
+my_chromadb = bench.load_module(None)
+
+COLLECTION = "test_collection"
+
+
+class _LateQueue(queue.Queue):
+    """_带超时的get总是超时,超时期间向量化线程放入最后一批并退出_"""
+
+    def get(self, block=True, timeout=None):
+        if timeout is not None:
+            time.sleep(0.3)
+            raise queue.Empty
+        return super().get(block, timeout)
+
+
+def test_last_batch_queued_before_encoder_exit_is_written(
+        tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        my_chromadb, "queue",
+        types.SimpleNamespace(Queue=_LateQueue,
+                              Empty=queue.Empty,
+                              Full=queue.Full))
+    monkeypatch.setattr(my_chromadb.mcfg, "MILVUS_INSERT_BATCH", 60)
+    docs = list(bench.generate_corpus(60, 60, 60, seed=0).values())[0]
+    milvus = my_chromadb.MyMilvus(str(tmp_path),
+                                  bench.FakeEmbedder(dim=64),
+                                  pipelined_ingest=True,
+                                  ingest_queue_size=1)
+    milvus.create_collection(COLLECTION)
+    milvus.add_document(docs, COLLECTION, None, {"progress": 0})
+    assert milvus.load_collection(COLLECTION).count() == 60
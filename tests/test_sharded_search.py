@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   test_sharded_search.py
+@Version :   1.0
+@Desc    :   多分片集合的检索结果与单分片一致
+'''
+import os
+import sys
+import pytest
+
+pytest.importorskip("chromadb")
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "benchmarks"))
+import bench_my_chromadb as bench  # noqa: E402
+
+my_chromadb = bench.load_module(None)
+
+COLLECTION = "test_collection"
+
+
+def _strip_ids(value):
+    """_去掉随机生成的id,保留其余字段比较_"""
+    if isinstance(value, list):
+        return [_strip_ids(item) for item in value]
+    if isinstance(value, dict):
+        return {
+            key: round(item, 5) if isinstance(item, float) else item
+            for key, item in value.items() if key != "id"
+        }
+    return value
+
+
+def _search_all(milvus, docs):
+    query = docs[7].sentence[:30]
+    return (milvus.similarity_query_hybrid_search(COLLECTION,
+                                                  query,
+                                                  3,
+                                                  threshold=0),
+            milvus.similarity_filter_hybrid_search(COLLECTION,
+                                                   query,
+                                                   {"is_title": {
+                                                       "$ne": 1
+                                                   }},
+                                                   3,
+                                                   threshold=0),
+            milvus.similarity_query_batch(
+                COLLECTION, [query, docs[50].sentence[:20]], 3,
+                threshold=0))
+
+
+def _build(path, docs, num_shards):
+    milvus = my_chromadb.MyMilvus(str(path),
+                                  bench.FakeEmbedder(dim=64),
+                                  num_shards=num_shards)
+    milvus.create_collection(COLLECTION)
+    milvus.add_document(docs, COLLECTION, None, {"progress": 0})
+    return milvus
+
+
+def test_sharded_search_matches_single_shard(tmp_path):
+    corpus = bench.generate_corpus(200, 5, 20, seed=0)
+    docs = [chunk for chunks in corpus.values() for chunk in chunks]
+    single = _search_all(_build(tmp_path / "single", docs, 1), docs)
+    sharded = _search_all(_build(tmp_path / "sharded", docs, 3), docs)
+    for result in sharded:
+        assert result
+    assert _strip_ids(list(sharded)) == _strip_ids(list(single))
+
+
+def test_reopen_with_different_num_shards_raises(tmp_path):
+    my_chromadb.MyMilvus(str(tmp_path), bench.FakeEmbedder(dim=64),
+                         num_shards=3)
+    with pytest.raises(Exception, match="num_shards=2"):
+        my_chromadb.MyMilvus(str(tmp_path),
+                             bench.FakeEmbedder(dim=64),
+                             num_shards=2)
+    my_chromadb.MyMilvus(str(tmp_path), bench.FakeEmbedder(dim=64),
+                         num_shards=3)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+@File    :   test_vector_reduction.py
+@Version :   1.0
+@Desc    :   降维集合的原始向量旁路存储与召回率评估
+'''
+import os
+import sys
+import pytest
+
+pytest.importorskip("chromadb")
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                 "benchmarks"))
+import bench_my_chromadb as bench  # noqa: E402
+
+my_chromadb = bench.load_module(None)
+
+COLLECTION = "test_collection"
+
+
+def test_evaluate_vector_recall_after_restart(tmp_path):
+    corpus = bench.generate_corpus(200, 5, 20, seed=0)
+    docs = [chunk for chunks in corpus.values() for chunk in chunks]
+    milvus = my_chromadb.MyMilvus(str(tmp_path), bench.FakeEmbedder(dim=64))
+    milvus.create_collection(COLLECTION,
+                             vector_dim=32,
+                             keep_full_vectors=True)
+    milvus.add_document(docs, COLLECTION, None, {"progress": 0})
+    queries = [doc.sentence[:20] for doc in docs[:10]]
+    expected = milvus.evaluate_vector_recall(COLLECTION, queries, k=5)
+    assert expected is not None
+
+    # 重启后旁路存储尚未打开
+    restarted = my_chromadb.MyMilvus(str(tmp_path),
+                                     bench.FakeEmbedder(dim=64))
+    assert restarted.evaluate_vector_recall(COLLECTION, queries,
+                                            k=5) == expected
+    assert expected["rescored"] >= expected["reduced"]